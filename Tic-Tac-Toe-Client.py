@@ -1,49 +1,71 @@
+import getpass
+import sys
+import time
 from tkinter import *
 from tkinter import messagebox
 from socket import *
 from threading import *
+from queue import SimpleQueue, Empty
+from tictactoe_board import Board, MARKS, X_WINS, DRAW
+from tictactoe_protocol import FrameDecoder, encode
+from tictactoe_protocol import MSG_ACK, MSG_ERROR, MSG_JOIN, MSG_MOVE, MSG_RESULT, MSG_SNAPSHOT, MSG_START, MSG_WATCH
+from tictactoe_protocol import MSG_RESUME, NAME_SIZE, NO_MATCH
 
 #when using astrisk with tkinter messagebox generates an error as it's not included
 # we include messagebox in its own line to solve this problem
+#################################connection######################################################
+#the server owns the game: it tells us the board size, our side, which moves
+#were accepted and the result. the client only draws what it is told
+#"--watch N" follows match N as a spectator instead of playing
+WATCH = int(sys.argv[sys.argv.index("--watch") + 1]) if "--watch" in sys.argv else None
+#"--name NAME" is how the leaderboard knows us, the login name by default
+NAME = sys.argv[sys.argv.index("--name") + 1] if "--name" in sys.argv else getpass.getuser()
+s = socket(AF_INET,SOCK_STREAM)
+host="127.0.0.1"
+port= 6000
+s.connect((host,port))
+if WATCH is None:
+    s.send(encode(MSG_JOIN, 0, 0, 0, NAME.encode('utf-8')[:NAME_SIZE]))
+else:
+    s.send(encode(MSG_WATCH, WATCH))
+
+decoder = FrameDecoder()
+start = None
+early = [] #frames that came in the same read as the start
+while start is None:
+    x = s.recv(2048)
+    if not x:
+        sys.exit("the server closed the connection")
+    for frame in decoder.feed(x):
+        if start is None and frame[0] == MSG_ERROR:
+            sys.exit("there is no match %d to watch" % frame[1])
+        if start is None and frame[0] in (MSG_START, MSG_SNAPSHOT):
+            start = frame
+        elif start is not None:
+            early.append(frame)
+#################################settings########################################################
+msg_type, game, seq, side, payload = start
+if msg_type == MSG_SNAPSHOT:
+    #a spectator gets the whole board instead of a side
+    early.insert(0, start)
+    SIZE = payload[0]
+    ME, THEM = None, None
+else:
+    SIZE, LENGTH = (payload[0], payload[1]) if payload else (3, 3)
+    ME, THEM = MARKS[side], MARKS[1 - side]
+TOKEN = payload[2:] if msg_type == MSG_START else b'' #gets our seat back after a reconnect
 #################################window##########################################################
 window = Tk()
 window.title("Tic Tac Toe Client")
-window.geometry("400x300")
-################################check############################################################
-flag = 1
-def check():
-    global flag
-    #############################button labels########################################################
-    bt1 = btn1['text']
-    bt2 = btn2['text']
-    bt3 = btn3['text']
-    bt4 = btn4['text']
-    bt5 = btn5['text']
-    bt6 = btn6['text']
-    bt7 = btn7['text']
-    bt8 = btn8['text']
-    bt9 = btn9['text']
-    #################################################################################################
-    flag += 1
-    if flag == 10:
+if SIZE == 3:
+    window.geometry("400x300") #larger boards let tk size the window
+################################result###########################################################
+def show_result(result):
+    if result == DRAW:
         messagebox.showinfo("Draw", "The game result is draw")
         window.destroy()
-    if (bt1 == bt2 and bt2 == bt3 and bt1 == 'x') or (bt1 == bt2 and bt2 == bt3 and bt1 == 'o'):
-        win(bt1)
-    if (bt4 == bt5 and bt5 == bt6 and bt4 == 'x') or (bt4 == bt5 and bt5 == bt6 and bt4 == 'o'):
-        win(bt4)
-    if (bt7 == bt8 and bt8 == bt9 and bt7 == 'x') or (bt7 == bt8 and bt8 == bt9 and bt7 == 'o'):
-        win(bt7)
-    if (bt1 == bt4 and bt4 == bt7 and bt1 == 'x') or (bt1 == bt4 and bt4 == bt7 and bt1 == 'o'):
-        win(bt1)
-    if (bt2 == bt5 and bt5 == bt8 and bt2 == 'x') or (bt2 == bt5 and bt5 == bt8 and bt2 == 'o'):
-        win(bt2)
-    if (bt3 == bt6 and bt6 == bt9 and bt3 == 'x') or (bt3 == bt6 and bt6 == bt9 and bt3 == 'o'):
-        win(bt3)
-    if (bt1 == bt5 and bt5 == bt9 and bt1 == 'x') or (bt1 == bt5 and bt5 == bt9 and bt1 == 'o'):
-        win(bt1)
-    if (bt3 == bt5 and bt5 == bt7 and bt3 == 'x') or (bt3 == bt5 and bt5 == bt7 and bt3 == 'o'):
-        win(bt3)
+    else:
+        win(MARKS[result - X_WINS])
 ############################win##################################################################
 #################################################################################################
 def win(player):
@@ -51,143 +73,132 @@ def win(player):
     window.destroy()
 ############################clicked##############################################################
 #################################################################################################
-def clicked1():
-    if btn1['text'] == " ":
-        #global turn
-        btn1['text'] = 'o'
-        send('a')
-        check()
-#################################################################################################
-def clicked2():
-    if btn2['text'] == " ":
-        #global turn
-        btn2['text'] = 'o'
-        send('b')
-        check()
-#################################################################################################
-def clicked3():
-    if btn3['text'] == " ":
-        #global turn
-        btn3['text'] = 'o'
-        send('c')
-        check()
-#################################################################################################
-def clicked4():
-    if btn4['text'] == " ":
-        #global turn
-        btn4['text'] = 'o'
-        send('d')
-        check()
-#################################################################################################
-def clicked5():
-    if btn5['text'] == " ":
-        #global turn
-        btn5['text'] = 'o'
-        send('e')
-        check()
+def clicked(cell):
+    #the mark is drawn when the server accepts the move
+    if WATCH is None and buttons[cell]['text'] == " ":
+        send(cell)
+############################paint################################################################
 #################################################################################################
-def clicked6():
-    if btn6['text'] == " ":
-        #global turn
-        btn6['text'] = 'o'
-        send('f')
-        check()
-#################################################################################################
-def clicked7():
-    if btn7['text'] == " ":
-        #global turn
-        btn7['text'] = 'o'
-        send('g')
-        check()
-#################################################################################################
-def clicked8():
-    if btn8['text'] == " ":
-        #global turn
-        btn8['text'] = 'o'
-        send('h')
-        check()
-#################################################################################################
-def clicked9():
-    if btn9['text'] == " ":
-        #global turn
-        btn9['text'] = 'o'
-        send('i')
-        check()
+def paint(board):
+    #redraw every cell from a snapshot
+    for cell in range(SIZE * SIZE):
+        if board.x >> cell & 1:
+            buttons[cell]['text'] = MARKS[0]
+        elif board.o >> cell & 1:
+            buttons[cell]['text'] = MARKS[1]
+        else:
+            buttons[cell]['text'] = " "
 #############################label###############################################################
-lbl1 = Label(window, text="Server: x", font=("Helvetica", "15"))
-lbl1.grid(row=0, column=0)
-
-lbl2 = Label(window, text="Client: o", font=("Helvetica", "15"))
-lbl2.grid(row=1, column=0)
+if WATCH is None:
+    lbl1 = Label(window, text="You: " + ME, font=("Helvetica", "15"))
+    lbl1.grid(row=0, column=0)
+
+    lbl2 = Label(window, text="Opponent: " + THEM, font=("Helvetica", "15"))
+    lbl2.grid(row=1, column=0)
+else:
+    lbl1 = Label(window, text="Watching: " + str(WATCH), font=("Helvetica", "15"))
+    lbl1.grid(row=0, column=0)
 ##############################button#############################################################
-btn1 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked1)
-btn1.grid(row=0, column=1)
-
-btn2 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked2)
-btn2.grid(row=0, column=2)
-
-btn3 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked3)
-btn3.grid(row=0, column=3)
-
-btn4 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked4)
-btn4.grid(row=1, column=1)
-
-btn5 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked5)
-btn5.grid(row=1, column=2)
-
-btn6 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked6)
-btn6.grid(row=1, column=3)
-
-btn7 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked7)
-btn7.grid(row=2, column=1)
-
-btn8 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked8)
-btn8.grid(row=2, column=2)
-
-btn9 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked9)
-btn9.grid(row=2, column=3)
+#one button per cell, cell number = row * SIZE + column
+buttons = []
+for cell in range(SIZE * SIZE):
+    btn = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=lambda cell=cell: clicked(cell))
+    btn.grid(row=cell // SIZE, column=cell % SIZE + 1)
+    buttons.append(btn)
 
 ####################################################################################################
 
-def handler():
-    while True :
-        x = s.recv(2048)
-        x = x.decode('UTF-8')
-        if x == 'a':
-            btn1['text'] = 'x'
-        elif x == 'b':
-            btn2['text'] = 'x'
-        elif x == 'c':
-            btn3['text'] = 'x'
-        elif x == 'd':
-            btn4['text'] = 'x'
-        elif x == 'e':
-            btn5['text'] = 'x'
-        elif x == 'f':
-            btn6['text'] = 'x'
-        elif x == 'g':
-            btn7['text'] = 'x'
-        elif x == 'h':
-            btn8['text'] = 'x'
-        elif x == 'i':
-            btn9['text'] = 'x'
-
-
-
+#tk widgets may only be touched by the thread running mainloop(), the network
+#thread puts the frames in a queue and drain() applies them from window.after()
+events = SimpleQueue()
+for frame in early:
+    events.put(frame)
+DRAIN_MS = 15
+RECONNECT_TRIES = 8
+
+def reconnect():
+    #the link dropped: connect again and ask for our seat back. the server
+    #answers with one snapshot of the board, not with every move we missed
+    global s, decoder
+    for attempt in range(RECONNECT_TRIES):
+        time.sleep(min(0.1 * 2 ** attempt, 2))
+        try:
+            c = create_connection((host, port))
+        except OSError:
+            continue
+        decoder = FrameDecoder()
+        if WATCH is None:
+            c.send(encode(MSG_RESUME, game, 0, 0, TOKEN))
+        else:
+            c.send(encode(MSG_WATCH, WATCH))
+        s = c
+        return True
+    return False
 
+def handler():
+    #recv() returns whatever bytes arrived, several moves or half of one,
+    #the decoder cuts them into frames
+    over = False
+    while True:
+        try:
+            x = s.recv(2048)
+        except OSError:
+            x = b''
+        if not x:
+            if over:
+                break #the server closes the link after the result
+            if reconnect():
+                continue
+            events.put((MSG_ERROR, game, 0, NO_MATCH, b''))
+            break
+        for frame in decoder.feed(x):
+            if frame[0] == MSG_RESULT:
+                over = True
+            events.put(frame)
+
+def drain():
+    #everything that arrived since the last call is applied in one batch,
+    #tk redraws the buttons once afterwards
+    result = None
+    while True:
+        try:
+            msg_type, game, seq, cell, payload = events.get_nowait()
+        except Empty:
+            break
+        if msg_type == MSG_ACK:
+            buttons[cell]['text'] = ME
+        elif msg_type == MSG_MOVE and WATCH is not None:
+            #x makes the odd moves
+            buttons[cell]['text'] = MARKS[(seq - 1) % 2]
+        elif msg_type == MSG_MOVE:
+            buttons[cell]['text'] = THEM
+        elif msg_type == MSG_SNAPSHOT:
+            paint(Board.from_bytes(payload))
+        elif msg_type == MSG_RESULT:
+            result = cell
+        elif msg_type == MSG_ERROR and cell == NO_MATCH:
+            messagebox.showinfo("Disconnected", "the game is lost, the server cannot be reached")
+            window.destroy()
+            return
+    if result is not None:
+        show_result(result) #closes the window
+    else:
+        window.after(DRAIN_MS, drain)
 
 
 
-s = socket(AF_INET,SOCK_STREAM)
-host="127.0.0.1"
-port= 6000
-s.connect((host,port))
 
 ithread=Thread(target=handler)
 ithread.daemon=True
 ithread.start()
-def send(y):
-    s.send(y.encode('UTF-8'))
-
+seq = 0
+def send(cell):
+    global seq
+    seq += 1
+    try:
+        s.send(encode(MSG_MOVE, game, seq, cell))
+    except OSError:
+        pass #the link is down, the click is lost and the handler reconnects
+
+window.after(DRAIN_MS, drain)
 window.mainloop()
-
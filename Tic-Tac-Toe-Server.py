@@ -1,49 +1,75 @@
+import getpass
+import os
+import sys
+#--headless runs the asyncio server instead of the window, it hosts many matches at once
+if '--headless' in sys.argv:
+    from tictactoe_server import main
+    main([arg for arg in sys.argv[1:] if arg != '--headless'])
+    sys.exit()
+
 from tkinter import *
 from tkinter import messagebox
 from socket import *
 from threading import *
+from queue import SimpleQueue, Empty
+from tictactoe_board import Board, MARKS, X, O, ONGOING, X_WINS, DRAW
+from tictactoe_journal import Journal, next_match_id
+from tictactoe_protocol import FrameBuffer, FrameDecoder, Limiter, ProtocolError, encode
+from tictactoe_protocol import MSG_ACK, MSG_ERROR, MSG_JOIN, MSG_MOVE, MSG_RESULT, MSG_START
+from tictactoe_protocol import MSG_RESUME, MSG_SNAPSHOT, NAME_SIZE, NO_MATCH, TOKEN_SIZE
+from tictactoe_results import ResultStore
 
 #when using astrisk with tkinter messagebox generates an error as it's not included
 # we include messagebox in its own line to solve this problem
+#################################settings########################################################
+#board size and how many in a row win, e.g. "python Tic-Tac-Toe-Server.py 15 5" for five in a row
+#the client is told the settings when it connects
+args = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+SIZE = int(args[0]) if len(args) > 0 else 3
+LENGTH = int(args[1]) if len(args) > 1 else SIZE
+#both go to the client in one byte each, and a single stone must not win
+if not 3 <= SIZE <= 255:
+    sys.exit("the board size must be between 3 and 255")
+if not 2 <= LENGTH <= SIZE:
+    sys.exit("the length must be between 2 and the board size")
+#################################journal#########################################################
+#every move is appended to the journal, "python tictactoe_journal.py tictactoe.journal <id>"
+#replays a finished match
+JOURNAL = "tictactoe.journal"
+MATCH_ID = next_match_id(JOURNAL)
+journal = Journal(JOURNAL)
+moves = 0
+def record(side, cell):
+    global moves
+    moves += 1
+    journal.move(MATCH_ID, moves, side, cell)
+#################################results#########################################################
+#the finished match goes to the leaderboard, "python tictactoe_results.py tictactoe.results"
+#shows it. a writer thread does the sqlite work, the window never waits for the disk
+RESULTS = "tictactoe.results"
+results = ResultStore(RESULTS)
 #################################window##########################################################
 window = Tk()
 window.title("Tic Tac Toe Server")
-window.geometry("400x300")
+if SIZE == 3:
+    window.geometry("400x300") #larger boards let tk size the window
 ################################check############################################################
-flag = 1
+#the game state lives in the bitboard engine, the buttons only show it.
+#this board is the only one: the client's moves are checked against it
+#and the client is sent the result, it does not decide anything itself
+board = Board(size=SIZE, length=LENGTH)
 def check():
-    global flag
-    #############################button labels########################################################
-    bt1 = btn1['text']
-    bt2 = btn2['text']
-    bt3 = btn3['text']
-    bt4 = btn4['text']
-    bt5 = btn5['text']
-    bt6 = btn6['text']
-    bt7 = btn7['text']
-    bt8 = btn8['text']
-    bt9 = btn9['text']
-    #################################################################################################
-    flag += 1
-    if flag == 10:
+    result = board.result
+    if result != ONGOING:
+        journal.result(MATCH_ID, result)
+        journal.close() #written and fsynced before the window goes
+        results.record(players[X], players[O], result, moves, SIZE, LENGTH, MATCH_ID)
+        results.close()
+    if result == DRAW:
         messagebox.showinfo("Draw", "The game result is draw")
         window.destroy()
-    if (bt1 == bt2 and bt2 == bt3 and bt1 == 'x') or (bt1 == bt2 and bt2 == bt3 and bt1 == 'o'):
-        win(bt1)
-    if (bt4 == bt5 and bt5 == bt6 and bt4 == 'x') or (bt4 == bt5 and bt5 == bt6 and bt4 == 'o'):
-        win(bt4)
-    if (bt7 == bt8 and bt8 == bt9 and bt7 == 'x') or (bt7 == bt8 and bt8 == bt9 and bt7 == 'o'):
-        win(bt7)
-    if (bt1 == bt4 and bt4 == bt7 and bt1 == 'x') or (bt1 == bt4 and bt4 == bt7 and bt1 == 'o'):
-        win(bt1)
-    if (bt2 == bt5 and bt5 == bt8 and bt2 == 'x') or (bt2 == bt5 and bt5 == bt8 and bt2 == 'o'):
-        win(bt2)
-    if (bt3 == bt6 and bt6 == bt9 and bt3 == 'x') or (bt3 == bt6 and bt6 == bt9 and bt3 == 'o'):
-        win(bt3)
-    if (bt1 == bt5 and bt5 == bt9 and bt1 == 'x') or (bt1 == bt5 and bt5 == bt9 and bt1 == 'o'):
-        win(bt1)
-    if (bt3 == bt5 and bt5 == bt7 and bt3 == 'x') or (bt3 == bt5 and bt5 == bt7 and bt3 == 'o'):
-        win(bt3)
+    elif result != ONGOING:
+        win(MARKS[result - X_WINS])
 ############################win##################################################################
 #################################################################################################
 def win(player):
@@ -51,67 +77,12 @@ def win(player):
     window.destroy()
 ############################clicked##############################################################
 #################################################################################################
-def clicked1():
-    if btn1['text'] == " ":
-        #global turn
-        btn1['text'] = 'x'
-        send('a')
-        check()
-#################################################################################################
-def clicked2():
-    if btn2['text'] == " ":
-        #global turn
-        btn2['text'] = 'x'
-        send('b')
-        check()
-#################################################################################################
-def clicked3():
-    if btn3['text'] == " ":
-        #global turn
-        btn3['text'] = 'x'
-        send('c')
-        check()
-#################################################################################################
-def clicked4():
-    if btn4['text'] == " ":
-        #global turn
-        btn4['text'] = 'x'
-        send('d')
-        check()
-#################################################################################################
-def clicked5():
-    if btn5['text'] == " ":
-        #global turn
-        btn5['text'] = 'x'
-        send('e')
-        check()
-#################################################################################################
-def clicked6():
-    if btn6['text'] == " ":
-        #global turn
-        btn6['text'] = 'x'
-        send('f')
-        check()
-#################################################################################################
-def clicked7():
-    if btn7['text'] == " ":
-        #global turn
-        btn7['text'] = 'x'
-        send('g')
-        check()
-#################################################################################################
-def clicked8():
-    if btn8['text'] == " ":
-        #global turn
-        btn8['text'] = 'x'
-        send('h')
-        check()
-#################################################################################################
-def clicked9():
-    if btn9['text'] == " ":
-        #global turn
-        btn9['text'] = 'x'
-        send('i')
+def clicked(cell):
+    if not board.illegal(cell, X): #x's turn and the cell is free
+        buttons[cell]['text'] = 'x'
+        board.play(cell, X)
+        record(X, cell)
+        send(cell)
         check()
 #############################label###############################################################
 lbl1 = Label(window, text="Server: x", font=("Helvetica", "15"))
@@ -120,57 +91,101 @@ lbl1.grid(row=0, column=0)
 lbl2 = Label(window, text="Clinet: o", font=("Helvetica", "15"))
 lbl2.grid(row=1, column=0)
 ##############################button#############################################################
-btn1 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked1)
-btn1.grid(row=0, column=1)
-
-btn2 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked2)
-btn2.grid(row=0, column=2)
-
-btn3 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked3)
-btn3.grid(row=0, column=3)
-
-btn4 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked4)
-btn4.grid(row=1, column=1)
-
-btn5 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked5)
-btn5.grid(row=1, column=2)
-
-btn6 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked6)
-btn6.grid(row=1, column=3)
-
-btn7 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked7)
-btn7.grid(row=2, column=1)
-
-btn8 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked8)
-btn8.grid(row=2, column=2)
-
-btn9 = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=clicked9)
-btn9.grid(row=2, column=3)
+#one button per cell, cell number = row * SIZE + column
+buttons = []
+for cell in range(SIZE * SIZE):
+    btn = Button(window, text=" ", bg="yellow", fg="black", width=3, height=1, command=lambda cell=cell: clicked(cell))
+    btn.grid(row=cell // SIZE, column=cell % SIZE + 1)
+    buttons.append(btn)
 
 ###########################################################################################################
 
+#tk widgets may only be touched by the thread running mainloop(), the network
+#thread puts the frames in a queue and drain() applies them from window.after()
+events = SimpleQueue()
+DRAIN_MS = 15
+#a client sending more than this is cut off before its bytes are decoded
+MAX_MESSAGES = 100 #a second
+MAX_BYTES = 64 * 1024 #a second
+
 def handler():
+    #recv() returns whatever bytes arrived, several moves or half of one,
+    #the decoder cuts them into frames
+    global conn
+    decoder = FrameDecoder()
+    limiter = Limiter(MAX_MESSAGES, MAX_BYTES)
     while True:
-        x = conn.recv (2048)
-        x = x.decode ('UTF-8')
-        if x == 'a':
-            btn1['text'] = 'o'
-        elif x == 'b':
-            btn2['text'] = 'o'
-        elif x == 'c':
-            btn3['text'] = 'o'
-        elif x == 'd':
-            btn4['text'] = 'o'
-        elif x == 'e':
-            btn5['text'] = 'o'
-        elif x == 'f':
-            btn6['text'] = 'o'
-        elif x == 'g':
-            btn7['text'] = 'o'
-        elif x == 'h':
-            btn8['text'] = 'o'
-        elif x == 'i':
-            btn9['text'] = 'o'
+        try:
+            x = conn.recv(2048)
+            if x:
+                limiter.read(x)
+                frames = decoder.feed(x)
+                limiter.frames(len(frames))
+        except (OSError, ProtocolError): #a flood or bytes that are no frames
+            x = b''
+        if not x:
+            #the client is gone, the game waits for it to come back. conn is
+            #the new socket before its resume is queued, drain() answers on it
+            conn.close()
+            conn, decoder, frames = welcome_back()
+            limiter = Limiter(MAX_MESSAGES, MAX_BYTES)
+        for frame in frames:
+            events.put(frame)
+
+def welcome_back():
+    #only a client that sends MSG_RESUME with our token gets the seat
+    while True:
+        c, add = s.accept()
+        c.settimeout(5)
+        decoder = FrameDecoder()
+        frames = []
+        try:
+            while not frames:
+                x = c.recv(2048)
+                if not x:
+                    break
+                frames = decoder.feed(x)
+            if frames and frames[0][0] == MSG_RESUME and frames[0][4] == TOKEN:
+                c.settimeout(None)
+                return c, decoder, frames #drain() answers the resume with a snapshot
+            c.send(encode(MSG_ERROR, 0, 0, NO_MATCH))
+        except OSError:
+            pass
+        c.close()
+
+def drain():
+    #everything that arrived since the last call is applied in one batch,
+    #tk redraws the buttons once afterwards
+    if board.result != ONGOING:
+        return #our own click ended the game, clicked() has called check()
+    while True:
+        try:
+            msg_type, game, seq, cell, payload = events.get_nowait()
+        except Empty:
+            break
+        if msg_type == MSG_MOVE:
+            #out of turn, a taken cell or after the end: refused, not drawn
+            reason = board.illegal(cell, O)
+            if reason:
+                out.add(MSG_ERROR, 0, seq, reason)
+                continue
+            board.play(cell, O)
+            record(O, cell)
+            buttons[cell]['text'] = 'o'
+            out.add(MSG_ACK, 0, seq, cell)
+            if board.result != ONGOING:
+                out.add(MSG_RESULT, 0, 0, board.result)
+        elif msg_type == MSG_RESUME:
+            #the whole board in a few bytes, whatever the length of the game
+            out.add(MSG_SNAPSHOT, 0, moves, board.result, board.to_bytes())
+        elif msg_type == MSG_JOIN and payload:
+            players[O] = payload[:NAME_SIZE].decode('utf-8', 'replace')
+    flush() #all answers of the batch in one send
+    journal.write() #readers see the moves, fsync waits for the end of the game
+    if board.result != ONGOING:
+        check() #a move of this batch ended the game, this closes the window
+    else:
+        window.after(DRAIN_MS, drain)
 
 
 s = socket (AF_INET, SOCK_STREAM)
@@ -180,12 +195,30 @@ s.setsockopt (SOL_SOCKET, SO_REUSEADDR, 1) #for port reusability
 s.bind ((host, port))
 s.listen (5)
 conn, add = s.accept ()
+players = [getpass.getuser(), add[0]] #x is us, o the client until it tells its name
+journal.start(MATCH_ID, SIZE, LENGTH)
+TOKEN = os.urandom(TOKEN_SIZE) #the client needs it to reconnect
+conn.send(encode(MSG_START, 0, 0, O, bytes((SIZE, LENGTH)) + TOKEN)) #the client plays o on our board
 cthread = Thread (target=handler)
 cthread.daemon = True
 cthread.start()
 
-def send(y):
-    conn.send(y.encode('UTF-8'))
-
+out = FrameBuffer()
+def flush():
+    try:
+        out.flush(conn)
+    except OSError:
+        out.take() #the client is away, it gets a snapshot when it is back
+
+seq = 0
+def send(cell):
+    global seq
+    seq += 1
+    out.add(MSG_MOVE, 0, seq, cell)
+    if board.result != ONGOING:
+        out.add(MSG_RESULT, 0, 0, board.result)
+    flush()
+
+window.after(DRAIN_MS, drain)
 window.mainloop()
 
@@ -1,5 +1,13 @@
 # echo-client.py
 
+# --bench measures an echo server instead, many connections with many
+# messages in flight on each, see echo_bench.py
+import sys
+if '--bench' in sys.argv:
+    from echo_bench import main
+    main([arg for arg in sys.argv[1:] if arg != '--bench'])
+    sys.exit()
+
 import socket
 
 HOST = "127.0.0.1"  # The server's hostname or IP address
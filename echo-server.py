@@ -2,6 +2,14 @@
 
 
 
+# --serve keeps echoing every byte back to every client until it is
+# interrupted, on many connections at once, see echo_server.py
+import sys
+if '--serve' in sys.argv:
+    from echo_server import main
+    main([arg for arg in sys.argv[1:] if arg != '--serve'])
+    sys.exit()
+
 # first of all import the socket library 
 import socket			 
 
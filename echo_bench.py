@@ -0,0 +1,301 @@
+"""
+Throughput and latency benchmark for echo_server.py.
+
+echo-client.py sends one message and prints the reply. This module opens
+--connections connections to an echo server and keeps --pipeline messages
+in flight on each: a message is written, and every time a reply is
+complete the next message goes out, so a connection always has that many
+waiting for their echo (a closed loop, the latencies are those of a
+server with connections * pipeline messages queued). Message sizes are
+drawn from --sizes with a seeded random generator, the same seed gives
+the same sequence of messages.
+
+The echo is a byte stream, replies have no boundaries of their own: the
+client counts the bytes it got back, and message k is complete when the
+count reaches the end of message k. Its latency, from the write to that
+moment, goes into a Histogram. Like HdrHistogram it has buckets of
+constant relative width, at most 1/128 (0.8%) with the default 8
+significant bits, so it takes any number of samples in constant memory
+and time, and percentiles read off it are within 0.8% of the exact ones.
+
+The run lasts --warmup plus --duration seconds; only messages completed
+in the --duration part are counted. The JSON report has:
+  - msgs_per_sec and mb_per_sec, MB of payload echoed (one direction),
+  - latency_ms: p50, p90, p99, p999, p9999, max and mean,
+  - errors: connections lost before their replies were in.
+
+    python echo_server.py --engine selectors &
+    python echo_bench.py --connections 100 --pipeline 16 --sizes 64 1024
+or let it start the server with --spawn-server --engine asyncio; the
+server's own counters are then added to the report, and
+--server-workers N runs it pre-forked on N cores. --processes spreads
+the connections over client processes, one event loop each, for servers
+that are faster than one client process.
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+from echo_server import ENGINES, HOST, PORT
+from server_common import raise_fd_limit, wait_for_server
+
+BITS = 8  # significant bits of a histogram bucket, at most 0.8% wide
+
+
+class Histogram:
+    "HDR style latency histogram: buckets of constant relative width, counts only"
+
+    def __init__(self, bits=BITS):
+        self.bits = bits
+        self.half = 1 << (bits - 1)
+        self.counts = collections.Counter()  # bucket -> samples
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def bucket(self, value):
+        shift = value.bit_length() - self.bits
+        if shift <= 0:
+            return value  # small values are exact
+        return shift * self.half + (value >> shift)
+
+    def highest(self, bucket):
+        "Largest value that falls into bucket"
+        if bucket < 2 * self.half:
+            return bucket
+        shift = bucket // self.half - 1
+        return ((bucket - shift * self.half + 1) << shift) - 1
+
+    def record(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def value_at(self, q):
+        "The value below which a fraction q of the samples are"
+        rank = max(1, round(q * self.total))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.highest(bucket), self.max)
+        return self.max
+
+    def percentiles(self, unit=1e6):
+        "p50 to p9999, max and mean, values divided by unit (ns to ms by default)"
+        if not self.total:
+            return {}
+        report = {name: round(self.value_at(q) / unit, 4) for name, q in
+                  (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999), ('p9999', 0.9999))}
+        report['max'] = round(self.max / unit, 4)
+        report['mean'] = round(self.sum / self.total / unit, 4)
+        return report
+
+
+class Run:
+    "Counters shared by the connections of one client process"
+
+    def __init__(self, measure_from, stop_at):
+        self.measure_from = measure_from  # perf_counter_ns, the end of the warmup
+        self.stop_at = stop_at
+        self.stopping = False
+        self.latency = Histogram()
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+
+
+class EchoClient(asyncio.Protocol):
+    "One connection keeping pipeline messages in flight"
+
+    def __init__(self, run, sizes, pipeline, rng):
+        self.run = run
+        self.sizes = sizes
+        self.pipeline = pipeline
+        self.rng = rng
+        self.payloads = {size: os.urandom(size) for size in set(sizes)}
+        self.inflight = collections.deque()  # (end offset, sent at, size)
+        self.sent = 0  # bytes written
+        self.received = 0  # bytes echoed
+        self.transport = None
+        self.done = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        for _ in range(self.pipeline):
+            self.send()
+
+    def send(self):
+        size = self.rng.choice(self.sizes)
+        self.sent += size
+        self.inflight.append((self.sent, time.perf_counter_ns(), size))
+        self.transport.write(self.payloads[size])
+
+    def data_received(self, data):
+        now = time.perf_counter_ns()
+        self.received += len(data)
+        run = self.run
+        inflight = self.inflight
+        while inflight and inflight[0][0] <= self.received:
+            end, sent_at, size = inflight.popleft()
+            if run.measure_from <= now < run.stop_at:
+                run.latency.record(now - sent_at)
+                run.messages += 1
+                run.bytes += size
+            if not run.stopping:
+                self.send()
+        if run.stopping and not inflight:
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.inflight:
+            self.run.errors += 1
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+async def run_connections(host, port, connections, pipeline, sizes, duration, warmup, seed):
+    "Runs connections clients in this process, returns the Run"
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    start = time.perf_counter_ns()
+    run = Run(start + int(warmup * 1e9), start + int((warmup + duration) * 1e9))
+    clients = []
+    for _ in range(connections):
+        client = EchoClient(run, sizes, pipeline, random.Random(rng.getrandbits(64)))
+        try:
+            await loop.create_connection(lambda: client, host, port)
+        except OSError:
+            run.errors += 1
+            continue
+        clients.append(client)
+    await asyncio.sleep(max(0, run.stop_at - time.perf_counter_ns()) / 1e9)
+    run.stopping = True  # no new messages, the ones in flight are still read
+    try:
+        await asyncio.wait_for(asyncio.gather(*(client.done for client in clients)), 10.0)
+    except asyncio.TimeoutError:
+        for client in clients:
+            client.transport.abort()
+    return run
+
+
+def run_process(host, port, connections, pipeline, sizes, duration, warmup, seed):
+    "One client process of --processes, returns what the parent merges"
+    raise_fd_limit()
+    run = asyncio.run(run_connections(host, port, connections, pipeline, sizes, duration, warmup, seed))
+    return run.messages, run.bytes, run.errors, run.latency
+
+
+def benchmark(host, port, connections, pipeline, sizes, duration, warmup, seed=0, processes=1):
+    rng = random.Random(seed)
+    share = [connections // processes + (i < connections % processes) for i in range(processes)]
+    jobs = [(host, port, count, pipeline, sizes, duration, warmup, rng.getrandbits(64)) for count in share]
+    if processes == 1:
+        results = [run_process(*jobs[0])]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(run_process, *zip(*jobs)))
+    latency = Histogram()
+    messages = size = errors = 0
+    for done, payload, failed, histogram in results:
+        messages += done
+        size += payload
+        errors += failed
+        latency.merge(histogram)
+    return {
+        'host': host,
+        'port': port,
+        'connections': connections,
+        'pipeline': pipeline,
+        'sizes': sizes,
+        'processes': processes,
+        'seed': seed,
+        'duration_sec': duration,
+        'messages': messages,
+        'errors': errors,
+        'msgs_per_sec': round(messages / duration, 1),
+        'mb_per_sec': round(size / duration / 1e6, 2),
+        'latency_ms': latency.percentiles(),
+    }
+
+
+def spawn_server(args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'echo_server.py')
+    server = subprocess.Popen([sys.executable, script, '--host', args.host, '--port', str(args.port),
+                               '--engine', args.engine, '--workers', str(args.server_workers)],
+                              stdout=subprocess.PIPE, text=True)
+    server.stdout.readline()  # "echoing on ..." once it listens
+    asyncio.run(wait_for_server(args.host, args.port))
+    return server
+
+
+def stop_server(server):
+    "Interrupts the spawned server, returns the counters it prints on exit"
+    server.send_signal(signal.SIGINT)
+    out, _ = server.communicate()
+    lines = out.strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="echo server throughput and latency benchmark")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--connections', type=int, default=10)
+    parser.add_argument('--pipeline', type=int, default=1, help="messages in flight per connection")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64], help="message sizes in bytes to draw from")
+    parser.add_argument('--duration', type=float, default=10.0, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=1.0, help="seconds run before measuring")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=1, help="client processes sharing the connections")
+    parser.add_argument('--spawn-server', action='store_true', help="start echo_server.py for the run")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='selectors',
+                        help="engine of the spawned server")
+    parser.add_argument('--server-workers', type=int, default=1,
+                        help="worker processes of the spawned server, see echo_server.py --workers")
+    parser.add_argument('--out', default='echo_bench.json')
+    args = parser.parse_args(argv)
+    if args.connections < 1 or args.pipeline < 1 or args.processes < 1:
+        parser.error("--connections, --pipeline and --processes must be at least 1")
+    if args.processes > args.connections:
+        parser.error("--processes must not be above --connections")
+    if min(args.sizes) < 1:
+        parser.error("--sizes must be at least 1 byte")
+    raise_fd_limit()
+    server = spawn_server(args) if args.spawn_server else None
+    try:
+        report = benchmark(args.host, args.port, args.connections, args.pipeline, args.sizes,
+                           args.duration, args.warmup, args.seed, args.processes)
+    finally:
+        if server is not None:
+            counters = stop_server(server)
+    if server is not None:
+        report['engine'] = args.engine
+        report['server'] = counters
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
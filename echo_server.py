@@ -0,0 +1,561 @@
+"""
+Long running echo server, the baseline network service the rest of the
+stack is measured against.
+
+echo-server.py accepts one client, sends it a greeting, reads one message
+and exits. This module keeps serving: every byte a client sends is sent
+back to it, on as many connections at once as the file descriptor limit
+allows, until it is interrupted. There is no greeting, the replies are
+exactly the bytes received.
+
+The selectors engine is one thread around selectors.DefaultSelector, which
+is epoll on Linux (kqueue on BSD and macOS). All sockets are non-blocking
+and the loop only touches the ones the kernel reports ready, so an idle
+connection costs a file descriptor and a few hundred bytes, not a thread.
+
+Its data path makes no new object for the bytes it moves. A read goes with
+recv_into() into a buffer from the BufferPool, a bytearray of --chunk
+bytes held as a memoryview, and is echoed at once from a slice of that
+view; the buffer goes back to the pool as soon as the socket took it all.
+What the socket does not take stays where it is, the next read goes into
+the rest of that buffer while at least half of it is free, and everything
+waiting goes out with one sendmsg(), the slices gathered by the kernel. A client
+that sends faster than it reads gets up to --high-water bytes waiting,
+then the server stops reading from it until no more than --low-water
+bytes are left, so a slow reader costs bounded memory and holds up nobody
+else.
+
+--engine selectors-copy is the same loop with the data path the pool
+replaced: recv() returns a new bytes object every time and what the
+socket does not take is copied into a bytearray. It is kept to measure
+the pool against.
+
+--engine asyncio serves the same way with asyncio streams, a coroutine per
+connection from start_server. Backpressure is drain(): every write is
+followed by await writer.drain(), which returns at once while the
+transport holds less than --high-water bytes (set with
+set_write_buffer_limits), and otherwise waits until it is down to
+--low-water. The StreamReader is limited to --chunk bytes, beyond that the
+transport stops reading the socket, so both directions stay bounded.
+
+--bulk FILE makes every engine a file server for bulk transfers: each
+client is sent the whole file, then the connection is closed. The bytes
+go from the page cache to the socket inside the kernel with sendfile(2)
+and are never read into Python. The selectors engines call os.sendfile()
+at the connection's offset whenever the socket is writable,
+socket.sendfile() would do the same but refuses non-blocking sockets; the
+asyncio engine uses loop.sendfile().
+
+The engines take the same options, keep the same counters and are
+measured with the same client, echo_bench.py. On exit the counters are
+printed as one line of JSON; allocations counts the buffers the data path
+made for received bytes.
+
+Any one engine is one process and so one core. --workers N forks N of
+them (--workers 0 one per CPU) under the Supervisor of server_common.py.
+Every worker opens its own listening socket on the port with
+SO_REUSEPORT and the kernel spreads the new connections over them; a
+connection stays with the worker that accepted it. Each worker beats its
+heartbeat from its loop and, with every beat, writes its counters into
+its slot of a shared memory block made before the fork. The supervisor
+restarts a worker that dies or stops beating, keeps the counters of the
+dead one, and prints the sum of all of them and each worker's own on
+exit.
+
+    python echo_server.py --port 65432
+or  python echo-server.py --serve --engine asyncio --workers 0
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import mmap
+import os
+import selectors
+import socket
+import struct
+import time
+
+from server_common import HEARTBEAT, Supervisor, beat, raise_fd_limit
+
+HOST = '127.0.0.1'
+PORT = 65432
+CHUNK = 64 * 1024
+HIGH_WATER = 1024 * 1024
+POOL_SIZE = 256  # free buffers kept, more go to the garbage collector
+IOV_MAX = 512  # slices per sendmsg
+
+READ = selectors.EVENT_READ
+WRITE = selectors.EVENT_WRITE
+
+# a worker's slot in the shared counters: pid, then COUNTERS
+COUNTERS = ('connections', 'accepted', 'echoed_bytes', 'bulk_bytes', 'allocations')
+SLOT = struct.Struct('=%dq' % (1 + len(COUNTERS)))
+
+
+class BufferPool:
+    "Receive buffers for reuse, a new one is only made when none is free"
+
+    def __init__(self, size, keep=POOL_SIZE):
+        self.size = size
+        self.keep = keep
+        self.free = []
+        self.created = 0
+
+    def get(self):
+        if self.free:
+            return self.free.pop()
+        self.created += 1
+        return memoryview(bytearray(self.size))
+
+    def put(self, view):
+        if len(self.free) < self.keep:
+            self.free.append(view)
+
+
+class Connection:
+    "One client socket and the bytes it has not read back yet"
+
+    __slots__ = ('sock', 'out', 'pending', 'waiting', 'events', 'offset')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.out = bytearray()  # selectors-copy only
+        self.pending = collections.deque()  # [buffer, start, end] not sent yet
+        self.waiting = 0  # bytes in pending
+        self.events = READ
+        self.offset = None  # bytes of the --bulk file sent
+
+
+class SelectorEchoServer:
+    "Echoes every connection from one thread with non-blocking sockets and pooled buffers"
+
+    name = 'selectors'
+
+    def __init__(self, host=HOST, port=PORT, chunk=CHUNK, high_water=HIGH_WATER, low_water=None,
+                 backlog=4096, bulk=None, reuse_port=False):
+        self.chunk = chunk  # bytes read per recv
+        self.high_water = high_water
+        self.low_water = high_water // 4 if low_water is None else low_water
+        self.pool = BufferPool(chunk)
+        self.tick = None  # (seconds, callback) called from the loop, for the supervisor
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.create_server((host, port), backlog=backlog, reuse_port=reuse_port)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, READ, None)
+        self.bulk = None
+        if bulk is not None:
+            self.bulk = os.open(bulk, os.O_RDONLY)
+            self.bulk_size = os.fstat(self.bulk).st_size
+        self.connections = 0
+        self.accepted = 0
+        self.echoed = 0  # bytes
+        self.sent_files = 0  # bytes of --bulk
+
+    @property
+    def allocations(self):
+        return self.pool.created
+
+    def stats(self):
+        return {'engine': self.name, 'pid': os.getpid(), 'accepted': self.accepted,
+                'connections': self.connections, 'echoed_bytes': self.echoed,
+                'bulk_bytes': self.sent_files, 'allocations': self.allocations}
+
+    def accept(self):
+        # a burst of connections is taken in one wakeup
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return  # out of file descriptors, the rest waits in the backlog
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(sock)
+            if self.bulk is not None:
+                conn.offset = 0
+                conn.events = WRITE
+            self.selector.register(sock, conn.events, conn)
+            self.connections += 1
+            self.accepted += 1
+
+    def want(self, conn, events):
+        if conn.events != events:
+            conn.events = events
+            self.selector.modify(conn.sock, events, conn)
+
+    def close(self, conn):
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        self.connections -= 1
+        for view, start, end in conn.pending:
+            self.pool.put(view)
+        conn.pending.clear()
+
+    def readable(self, conn):
+        pending = conn.pending
+        tail = pending[-1] if pending else None
+        if tail is not None and tail[2] <= self.chunk // 2:
+            view, into = tail[0], tail[2]  # fill up the half empty buffer that waits anyway
+        else:
+            view, into = self.pool.get(), 0
+        try:
+            received = conn.sock.recv_into(view[into:] if into else view)
+        except (BlockingIOError, InterruptedError):
+            received = -1
+        except OSError:
+            received = 0
+        if received <= 0:
+            if not into:
+                self.pool.put(view)
+            if received == 0:
+                self.close(conn)
+            return
+        self.echoed += received
+        if into:
+            tail[2] += received
+            conn.waiting += received
+        elif pending:
+            pending.append([view, 0, received])  # behind already, keep the order
+            conn.waiting += received
+        else:
+            try:
+                sent = conn.sock.send(view[:received])
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.pool.put(view)
+                self.close(conn)
+                return
+            if sent == received:
+                self.pool.put(view)
+                return
+            pending.append([view, sent, received])
+            conn.waiting += received - sent
+        # stop reading a client that does not read its replies
+        self.want(conn, WRITE if conn.waiting > self.high_water else READ | WRITE)
+
+    def writable(self, conn):
+        pending = conn.pending
+        count = min(len(pending), IOV_MAX)
+        slices = [view[start:end] for view, start, end in (pending[i] for i in range(count))]
+        try:
+            sent = conn.sock.sendmsg(slices)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close(conn)
+            return
+        conn.waiting -= sent
+        while sent:
+            segment = pending[0]
+            if sent < segment[2] - segment[1]:
+                segment[1] += sent
+                break
+            sent -= segment[2] - segment[1]
+            pending.popleft()
+            self.pool.put(segment[0])
+        if not pending:
+            self.want(conn, READ)
+        elif not conn.events & READ and conn.waiting <= self.low_water:
+            self.want(conn, READ | WRITE)
+
+    def send_file(self, conn):
+        "The next part of the --bulk file, from the page cache to the socket"
+        try:
+            sent = os.sendfile(conn.sock.fileno(), self.bulk, conn.offset, self.bulk_size - conn.offset)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close(conn)
+            return
+        conn.offset += sent
+        self.sent_files += sent
+        if not sent or conn.offset >= self.bulk_size:
+            self.close(conn)
+
+    def serve_forever(self):
+        select = self.selector.select
+        timeout = None
+        if self.tick is not None:
+            timeout, callback = self.tick
+            next_tick = time.monotonic() + timeout
+        while True:
+            if timeout is not None and time.monotonic() >= next_tick:
+                callback()
+                next_tick = time.monotonic() + timeout
+            for key, events in select(timeout):
+                conn = key.data
+                if conn is None:
+                    self.accept()
+                    continue
+                if conn.offset is not None:
+                    self.send_file(conn)
+                    continue
+                if events & WRITE:
+                    self.writable(conn)
+                    if conn.sock.fileno() < 0:
+                        continue  # closed while writing
+                if events & READ:
+                    self.readable(conn)
+
+    def close_all(self):
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        if self.bulk is not None:
+            os.close(self.bulk)
+
+
+class CopyingEchoServer(SelectorEchoServer):
+    "The selectors loop with a new bytes object per read, to measure the pool against"
+
+    name = 'selectors-copy'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = 0
+
+    @property
+    def allocations(self):
+        return self.reads
+
+    def readable(self, conn):
+        try:
+            data = conn.sock.recv(self.chunk)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close(conn)
+            return
+        if not data:
+            self.close(conn)
+            return
+        self.reads += 1
+        self.echoed += len(data)
+        out = conn.out
+        if out:
+            out += data  # behind already, keep the order
+        else:
+            try:
+                sent = conn.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.close(conn)
+                return
+            if sent < len(data):
+                out += memoryview(data)[sent:]
+        if not out:
+            return
+        # stop reading a client that does not read its replies
+        self.want(conn, WRITE if len(out) > self.high_water else READ | WRITE)
+
+    def writable(self, conn):
+        out = conn.out
+        try:
+            sent = conn.sock.send(out)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close(conn)
+            return
+        del out[:sent]
+        if not out:
+            self.want(conn, READ)
+        elif not conn.events & READ and len(out) <= self.low_water:
+            self.want(conn, READ | WRITE)
+
+
+class AsyncioEchoServer:
+    "Echoes every connection with asyncio streams, drain() is the backpressure"
+
+    name = 'asyncio'
+
+    def __init__(self, host=HOST, port=PORT, chunk=CHUNK, high_water=HIGH_WATER, low_water=None,
+                 backlog=4096, bulk=None, reuse_port=False):
+        self.host = host
+        self.port = port
+        self.chunk = chunk
+        self.high_water = high_water
+        self.low_water = high_water // 4 if low_water is None else low_water
+        self.backlog = backlog
+        self.bulk = bulk
+        self.reuse_port = reuse_port
+        self.tick = None  # (seconds, callback) called from the loop, for the supervisor
+        self.connections = 0
+        self.accepted = 0
+        self.echoed = 0
+        self.sent_files = 0
+        self.allocations = 0  # one bytes object per read
+
+    def stats(self):
+        return {'engine': self.name, 'pid': os.getpid(), 'accepted': self.accepted,
+                'connections': self.connections, 'echoed_bytes': self.echoed,
+                'bulk_bytes': self.sent_files, 'allocations': self.allocations}
+
+    async def echo(self, reader, writer):
+        self.connections += 1
+        self.accepted += 1
+        writer.transport.set_write_buffer_limits(self.high_water, self.low_water)
+        try:
+            while True:
+                data = await reader.read(self.chunk)
+                if not data:
+                    break
+                self.allocations += 1
+                self.echoed += len(data)
+                writer.write(data)
+                await writer.drain()  # only waits above the high water mark
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def send_file(self, reader, writer):
+        self.connections += 1
+        self.accepted += 1
+        try:
+            with open(self.bulk, 'rb') as f:
+                self.sent_files += await asyncio.get_running_loop().sendfile(writer.transport, f)
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def ticking(self):
+        seconds, callback = self.tick
+        while True:
+            await asyncio.sleep(seconds)
+            callback()
+
+    async def serve(self):
+        handler = self.echo if self.bulk is None else self.send_file
+        server = await asyncio.start_server(handler, self.host, self.port, backlog=self.backlog,
+                                            limit=self.chunk, reuse_port=self.reuse_port or None)
+        ticking = asyncio.create_task(self.ticking()) if self.tick is not None else None
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if ticking is not None:
+                ticking.cancel()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def close_all(self):
+        pass  # asyncio.run closed the loop and its sockets
+
+
+ENGINES = {
+    'selectors': SelectorEchoServer,
+    'selectors-copy': CopyingEchoServer,
+    'asyncio': AsyncioEchoServer,
+}
+
+
+def publish(slots, shard, server):
+    "Write a worker's counters into its slot of the shared block"
+    stats = server.stats()
+    SLOT.pack_into(slots, shard * SLOT.size, os.getpid(), *(stats[name] for name in COUNTERS))
+
+
+class EchoSupervisor(Supervisor):
+    "Supervisor that adds up the counters the workers publish"
+
+    def __init__(self, workers, target, slots, engine):
+        super().__init__(workers, target)
+        self.slots = slots  # shared with the workers, one SLOT each
+        self.engine = engine
+        self.retired = dict.fromkeys(COUNTERS, 0)  # counters of workers that were replaced
+
+    def slot(self, shard):
+        pid, *values = SLOT.unpack_from(self.slots, shard * SLOT.size)
+        return dict(shard=shard, pid=pid, **dict(zip(COUNTERS, values)))
+
+    def restart(self, worker, why):
+        # its connections died with it, what it did before stays in the totals
+        for name, value in self.slot(worker.shard).items():
+            if name in self.retired and name != 'connections':
+                self.retired[name] += value
+        SLOT.pack_into(self.slots, worker.shard * SLOT.size, *[0] * (1 + len(COUNTERS)))
+        super().restart(worker, why)
+
+    def stats(self):
+        workers = [self.slot(shard) for shard in range(self.count)]
+        totals = {name: self.retired[name] + sum(worker[name] for worker in workers) for name in COUNTERS}
+        return dict(engine=self.engine, pid=os.getpid(), workers=self.count, restarts=self.restarts,
+                    **totals, per_worker=workers)
+
+
+def serve_workers(args, workers):
+    "Forks workers engines sharing the port and supervises them until interrupted"
+    slots = mmap.mmap(-1, SLOT.size * workers)  # anonymous and shared, the workers inherit it
+
+    def start(shard, heartbeat):
+        server = ENGINES[args.engine](args.host, args.port, args.chunk, args.high_water, args.low_water,
+                                      args.backlog, args.bulk, reuse_port=True)
+
+        def tick():
+            beat(heartbeat)
+            publish(slots, shard, server)
+
+        server.tick = (HEARTBEAT / 2, tick)
+        try:
+            server.serve_forever()
+        finally:
+            server.close_all()
+            publish(slots, shard, server)
+
+    supervisor = EchoSupervisor(workers, start, slots, args.engine)
+    supervisor.run()  # returns once the workers are stopped and have published their last counters
+    print(json.dumps(supervisor.stats()), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="echo server for benchmarks")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='selectors')
+    parser.add_argument('--chunk', type=int, default=CHUNK, help="bytes read per recv")
+    parser.add_argument('--high-water', type=int, default=HIGH_WATER,
+                        help="unsent bytes per connection before the server stops reading it")
+    parser.add_argument('--low-water', type=int, default=None,
+                        help="unsent bytes below which it reads again, default a quarter of --high-water")
+    parser.add_argument('--backlog', type=int, default=4096)
+    parser.add_argument('--bulk', default=None, metavar='FILE',
+                        help="send every client this file with sendfile instead of echoing")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="server processes sharing the port with SO_REUSEPORT, 0 for one per CPU")
+    args = parser.parse_args(argv)
+    raise_fd_limit()
+    if args.low_water is not None and args.low_water > args.high_water:
+        parser.error("--low-water must not be above --high-water")
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        parser.error("--workers needs fork() and SO_REUSEPORT")
+    doing = "echoing" if args.bulk is None else "sending %s" % args.bulk
+    if workers > 1:
+        print("%s on %s:%d with %d %s workers" % (doing, args.host, args.port, workers, args.engine),
+              flush=True)
+        serve_workers(args, workers)
+        return
+    server = ENGINES[args.engine](args.host, args.port, args.chunk, args.high_water, args.low_water,
+                                  args.backlog, args.bulk)
+    print("%s on %s:%d with %s" % (doing, args.host, args.port, args.engine), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close_all()
+        print(json.dumps(server.stats()), flush=True)
+
+
+if __name__ == '__main__':
+    main()
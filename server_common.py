@@ -0,0 +1,187 @@
+"""
+Helpers shared by the servers of this repository and their benchmarks.
+
+tictactoe_server.py and echo_server.py, tictactoe_bench.py and
+echo_bench.py all need a few things that have nothing to do with the game:
+more file descriptors than the default, for thousands of sockets, a
+benchmark that starts its server has to wait until it accepts, and a
+server that runs as several processes needs a supervisor for them. This
+module holds them and imports nothing of the game, so the echo server and
+its client stay a small network service that loads no board, bot or
+protocol code.
+
+One Python process runs one event loop under one GIL, so a single server
+process uses one core however many the machine has. The supervisor forks
+workers instead; every worker opens its own listening socket on the same
+port with SO_REUSEPORT and the Linux kernel spreads the incoming
+connections over them. Nothing is shared between the workers while they
+serve: every connection, and every match made of connections, lives in
+exactly one of them.
+
+Each worker writes a byte into its heartbeat pipe every HEARTBEAT seconds
+from its event loop. The supervisor waits on all pipes with select():
+a worker that exits is started again, and so is one whose heartbeat has
+been silent for longer than the timeout, because an event loop that does
+not come round any more does not serve its sockets either; it is killed
+first. Connections that a dead worker held are lost, the others carry on.
+
+    supervisor = Supervisor(4, start)   # start(shard, heartbeat_fd) serves until stopped
+    supervisor.run()
+
+The Supervisor is only for systems with fork(), i.e. not windows.
+"""
+
+import asyncio
+import os
+import select
+import signal
+import time
+import traceback
+
+HEARTBEAT = 1.0
+
+
+def raise_fd_limit():
+    "Thousands of sockets need more than the default 1024 file descriptors"
+    try:
+        import resource
+    except ImportError:  # not available on windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def wait_for_server(host, port, timeout=10.0):
+    "Retries a connection until the server at host:port accepts one"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+
+
+def beat(fd):
+    "Called by a worker every HEARTBEAT seconds"
+    try:
+        os.write(fd, b'.')
+    except BlockingIOError:
+        pass  # the supervisor has not read the last ones yet, it knows we are alive
+
+
+class Worker:
+    "The supervisor's view of one worker process"
+
+    def __init__(self, shard, pid, beats):
+        self.shard = shard
+        self.pid = pid
+        self.beats = beats  # read end of the heartbeat pipe
+        self.started = self.last_beat = time.monotonic()
+
+
+class Supervisor:
+    "Forks the workers, watches their heartbeats and restarts the dead and the stuck"
+
+    def __init__(self, workers, target, timeout=5.0, restart_delay=1.0):
+        self.count = workers
+        self.target = target  # target(shard, heartbeat_fd) runs in the worker
+        self.timeout = timeout
+        self.restart_delay = restart_delay  # a crashing worker is not restarted faster than this
+        self.workers = {}
+        self.restarts = 0
+
+    def spawn(self, shard):
+        beats, heartbeat = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(beats)
+                for worker in self.workers.values():
+                    os.close(worker.beats)
+                # stop like on ctrl-c, so the server can close its files; a
+                # target with an event loop replaces this with a handler of its own
+                signal.signal(signal.SIGTERM, signal.default_int_handler)
+                os.set_blocking(heartbeat, False)
+                self.target(shard, heartbeat)
+                status = 0
+            except KeyboardInterrupt:
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        os.close(heartbeat)
+        os.set_blocking(beats, False)
+        self.workers[shard] = Worker(shard, pid, beats)
+
+    def restart(self, worker, why):
+        print("worker %d (pid %d) %s, restarting" % (worker.shard, worker.pid, why))
+        os.close(worker.beats)
+        del self.workers[worker.shard]
+        wait = worker.started + self.restart_delay - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self.restarts += 1
+        self.spawn(worker.shard)
+
+    def check(self):
+        "Wait one heartbeat for news from the workers and act on it"
+        by_fd = {worker.beats: worker for worker in self.workers.values()}
+        ready, _, _ = select.select(list(by_fd), [], [], HEARTBEAT)
+        now = time.monotonic()
+        for fd in ready:
+            try:
+                if os.read(fd, 4096):
+                    by_fd[fd].last_beat = now
+            except BlockingIOError:
+                pass
+        # workers that exited, an empty read above was their pipe closing
+        by_pid = {worker.pid: worker for worker in self.workers.values()}
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in by_pid:
+                self.restart(by_pid[pid], "exited with status %d" % os.waitstatus_to_exitcode(status))
+        for worker in list(self.workers.values()):
+            if now - worker.last_beat > self.timeout:
+                os.kill(worker.pid, signal.SIGKILL)
+                os.waitpid(worker.pid, 0)
+                self.restart(worker, "missed its heartbeat for %.1f s" % (now - worker.last_beat))
+
+    def stop(self):
+        for worker in self.workers.values():
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for worker in self.workers.values():
+            try:
+                os.waitpid(worker.pid, 0)
+            except ChildProcessError:
+                pass
+            os.close(worker.beats)
+        self.workers.clear()
+
+    def run(self):
+        # kill/terminate stops the workers too, not only ctrl-c
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        for shard in range(self.count):
+            self.spawn(shard)
+        try:
+            while True:
+                self.check()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
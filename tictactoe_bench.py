@@ -0,0 +1,353 @@
+"""
+Headless load generator and latency benchmark for the Tic Tac Toe server.
+
+Both tkinter scripts need a person at the window, so nothing could measure
+the server under load. This module opens N bot players against a running
+server (tictactoe_server.py, or anything speaking tictactoe_protocol.py),
+lets them play random, scripted or minimax games, and writes a JSON report with:
+  - moves/sec and games/sec over the whole run,
+  - TCP connection setup time,
+  - move round trip time: from sending MSG_MOVE to receiving its MSG_ACK,
+each with p50/p99/p999 percentiles in milliseconds.
+
+Everything runs on localhost:
+    python tictactoe_server.py --port 6000 &
+    python tictactoe_bench.py --players 1000 --games 10 --out bench.json
+or let the benchmark start the server itself with --spawn-server, and add
+--server-workers N to compare a sharded server on N cores with one process.
+
+--channels K puts K players on every connection with MSG_CHANNEL, so 1000
+players need 1000 / K sockets; connect_ms then counts the connections.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+from server_common import wait_for_server
+from tictactoe_board import Board, ONGOING, X
+from tictactoe_bot import AlphaBetaBot
+from tictactoe_protocol import (FrameDecoder, encode, unpack_envelope,
+                                MSG_ACK, MSG_CHANNEL, MSG_ERROR, MSG_JOIN, MSG_MOVE, MSG_RESULT, MSG_START)
+
+HOST = '127.0.0.1'
+PORT = 6000
+
+
+def random_move(board, rng):
+    return rng.choice(board.free_cells())
+
+
+def scripted_move(board, rng):
+    "Always the lowest free cell, every game is the same"
+    return board.free_cells()[0]
+
+
+minimax_bots = {}
+
+
+def minimax_move(board, rng):
+    # one bot per board setting, larger boards get a small time budget
+    key = (board.size, board.length)
+    if key not in minimax_bots:
+        minimax_bots[key] = AlphaBetaBot(board.size, board.length,
+                                         time_budget=None if board.classic() else 0.05)
+    return minimax_bots[key].choose(board.x, board.o, board.to_move())
+
+
+STRATEGIES = {
+    'random': random_move,
+    'scripted': scripted_move,
+    'minimax': minimax_move,
+}
+
+
+class Stats:
+    "Numbers collected by all bots of one run"
+
+    def __init__(self):
+        self.connect = []
+        self.rtt = []
+        self.moves = 0
+        self.games = 0
+        self.errors = 0
+
+
+class Link:
+    "A connection of its own for every game"
+
+    def __init__(self, host, port, stats):
+        self.host = host
+        self.port = port
+        self.stats = stats
+
+    async def open(self):
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.stats.connect.append(time.perf_counter() - started)
+        self.decoder = FrameDecoder()
+        self.frames = collections.deque()
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    async def next_frame(self):
+        while not self.frames:
+            data = await self.reader.read(2048)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.frames.extend(self.decoder.feed(data))
+        return self.frames.popleft()
+
+    def close(self):
+        self.writer.close()
+
+
+class Multiplexer:
+    "One connection shared by the channels of several players"
+
+    def __init__(self, host, port, stats):
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.channels = {}  # number -> ChannelLink
+        self.opened = None
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.stats.connect.append(time.perf_counter() - started)
+        self.receiving = asyncio.create_task(self.receive())
+
+    def channel(self):
+        link = ChannelLink(self, len(self.channels))
+        self.channels[link.number] = link
+        return link
+
+    async def receive(self):
+        "Sort the envelopes of the server into the queues of the channels"
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for msg_type, _, _, number, payload in decoder.feed(data):
+                    if msg_type == MSG_CHANNEL and payload:
+                        self.channels[number].put(unpack_envelope(payload))
+        finally:
+            for link in self.channels.values():
+                link.put(None)
+
+    def close(self):
+        self.receiving.cancel()
+        self.writer.close()
+
+
+class ChannelLink:
+    "A player's channel on a Multiplexer, a new game goes on in the same channel"
+
+    def __init__(self, mux, number):
+        self.mux = mux
+        self.number = number
+        self.frames = collections.deque()
+        self.arrived = asyncio.Event()
+
+    async def open(self):
+        # the first player of the connection opens it, the others wait for that
+        if self.mux.opened is None:
+            self.mux.opened = asyncio.ensure_future(self.mux.connect())
+        await self.mux.opened
+        if self.mux.receiving.done():
+            raise ConnectionError("server closed the connection")
+        self.frames.clear()  # whatever is left of a game that timed out
+
+    def write(self, frame):
+        self.mux.writer.write(encode(MSG_CHANNEL, 0, 0, self.number, frame))
+
+    def put(self, frames):
+        if frames is None:
+            self.frames.append(None)  # the connection is gone
+        else:
+            self.frames.extend(frames)
+        self.arrived.set()
+
+    async def next_frame(self):
+        while not self.frames:
+            self.arrived.clear()
+            await self.arrived.wait()
+        if self.frames[0] is None:
+            raise ConnectionError("server closed the connection")
+        return self.frames.popleft()
+
+    def close(self):
+        # the server closes it after the result by itself, this is for a game cut short
+        if not self.mux.writer.is_closing():
+            self.mux.writer.write(encode(MSG_CHANNEL, 0, 0, self.number))
+
+
+class BotClient:
+    "One simulated player, plays whole games over the binary protocol"
+
+    def __init__(self, link, strategy, stats, seed=None):
+        self.link = link
+        self.strategy = strategy
+        self.stats = stats
+        self.rng = random.Random(seed)
+
+    async def play_game(self):
+        stats = self.stats
+        link = self.link
+        await link.open()
+        self.next_frame = link.next_frame
+        try:
+            link.write(encode(MSG_JOIN))
+            msg_type, game, seq, side, payload = await self.next_frame()
+            while msg_type != MSG_START:
+                msg_type, game, seq, side, payload = await self.next_frame()
+            # the server tells the board size and win length with the start
+            board = Board(size=payload[0], length=payload[1]) if payload else Board()
+            # the board is only kept to pick moves, the server decides the game
+            seq = 0
+            turn = X
+            result = None
+            while result is None:
+                if turn == side and board.result == ONGOING:
+                    cell = self.strategy(board, self.rng)
+                    seq += 1
+                    sent = time.perf_counter()
+                    link.write(encode(MSG_MOVE, game, seq, cell))
+                    while True:
+                        msg_type, _, ack, value, payload = await self.next_frame()
+                        if msg_type == MSG_ACK and ack == seq:
+                            break
+                        if msg_type == MSG_ERROR and ack == seq:
+                            raise ValueError("move refused, reason %d" % value)
+                    stats.rtt.append(time.perf_counter() - sent)
+                    stats.moves += 1
+                    board.play(cell, side)
+                    turn = 1 - side
+                else:
+                    msg_type, _, _, value, payload = await self.next_frame()
+                    if msg_type == MSG_MOVE:
+                        board.play(value, 1 - side)
+                        turn = side
+                    elif msg_type == MSG_RESULT:
+                        result = value
+            if side == 0:
+                stats.games += 1  # count every game once, by its x player
+        finally:
+            link.close()
+
+    async def run(self, games, timeout=30.0):
+        for _ in range(games):
+            try:
+                await asyncio.wait_for(self.play_game(), timeout)
+            except (ConnectionError, ValueError, asyncio.TimeoutError):
+                self.stats.errors += 1
+
+
+def percentiles(samples):
+    "p50/p99/p999/max of a list of seconds, in milliseconds"
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    last = len(samples) - 1
+
+    def at(q):
+        return round(samples[min(last, int(q * len(samples)))] * 1000, 4)
+
+    return {'p50': at(0.50), 'p99': at(0.99), 'p999': at(0.999),
+            'max': round(samples[last] * 1000, 4)}
+
+
+async def run_benchmark(host, port, players, games, strategy, seed=None, channels=1):
+    stats = Stats()
+    rng = random.Random(seed)
+    muxes = []
+    links = []
+    for i in range(players):
+        if channels == 1:
+            links.append(Link(host, port, stats))
+            continue
+        if i % channels == 0:
+            muxes.append(Multiplexer(host, port, stats))
+        links.append(muxes[-1].channel())
+    bots = [BotClient(link, STRATEGIES[strategy], stats, rng.random()) for link in links]
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(bot.run(games) for bot in bots))
+    finally:
+        for mux in muxes:
+            if mux.opened is not None and mux.opened.done() and not mux.opened.exception():
+                mux.close()
+    elapsed = time.perf_counter() - started
+    return {
+        'host': host,
+        'port': port,
+        'players': players,
+        'channels': channels,
+        'connections': len(muxes) if muxes else players * games,
+        'strategy': strategy,
+        'games': stats.games,
+        'moves': stats.moves,
+        'errors': stats.errors,
+        'elapsed_sec': round(elapsed, 4),
+        'moves_per_sec': round(stats.moves / elapsed, 1),
+        'games_per_sec': round(stats.games / elapsed, 1),
+        'connect_ms': percentiles(stats.connect),
+        'move_rtt_ms': percentiles(stats.rtt),
+    }
+
+
+async def main_async(args):
+    server = None
+    if args.spawn_server:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tictactoe_server.py')
+        server = await asyncio.create_subprocess_exec(
+            sys.executable, script, '--host', args.host, '--port', str(args.port),
+            '--workers', str(args.server_workers),
+            '--max-messages', '0', '--max-bytes', '0',  # the bots play far faster than people
+            stdout=asyncio.subprocess.DEVNULL)
+        await wait_for_server(args.host, args.port)
+    try:
+        return await run_benchmark(args.host, args.port, args.players, args.games,
+                                   args.strategy, args.seed, args.channels)
+    finally:
+        if server is not None:
+            server.terminate()
+            await server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tic Tac Toe server load generator")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--players', type=int, default=100, help="simulated players, paired two by two")
+    parser.add_argument('--games', type=int, default=10, help="games played by every player")
+    parser.add_argument('--strategy', choices=sorted(STRATEGIES), default='random')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--spawn-server', action='store_true', help="start tictactoe_server.py for the run")
+    parser.add_argument('--server-workers', type=int, default=1,
+                        help="worker processes of the spawned server, see tictactoe_server.py --workers")
+    parser.add_argument('--channels', type=int, default=1,
+                        help="players sharing one connection, 1 for a connection per game")
+    parser.add_argument('--out', default='bench.json')
+    args = parser.parse_args(argv)
+    if args.players % 2:
+        parser.error("--players must be even, every match needs two")
+    if args.channels < 1:
+        parser.error("--channels must be at least 1")
+    report = asyncio.run(main_async(args))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
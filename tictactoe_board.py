@@ -0,0 +1,225 @@
+"""
+Bitboard engine for Tic Tac Toe.
+
+The tkinter scripts decide the game by reading the text of nine buttons and
+comparing strings. Here a game is two 9-bit integers, one per player, where
+bit n is set when that player owns cell n:
+
+    0 | 1 | 2
+    3 | 4 | 5
+    6 | 7 | 8
+
+A player has won when one of the eight WIN_MASKS is fully contained in his
+mask. WINNING is that test precomputed for all 512 masks, so deciding a game
+is one table lookup. The module does not import tkinter, so the server, the
+bots and the benchmarks can all use it.
+
+Board also plays larger games, e.g. Board(size=15, length=5) for five in a
+row. Cell numbers go on row by row (cell = row * size + col) and the masks
+grow to size * size bits. There is no table for those: after every move
+wins_through() walks the four lines through the new stone only, so the
+cost of a move is O(length) whatever the size of the board.
+"""
+
+X, O = 0, 1
+MARKS = 'xo'
+
+ONGOING, X_WINS, O_WINS, DRAW = 0, 1, 2, 3
+
+# why a move is refused, see Board.illegal()
+GAME_OVER, NOT_YOUR_TURN, BAD_CELL = 1, 2, 3
+
+FULL = 0b111111111
+
+WIN_MASKS = (
+    0b000000111, 0b000111000, 0b111000000,  # rows
+    0b001001001, 0b010010010, 0b100100100,  # columns
+    0b100010001, 0b001010100,               # diagonals
+)
+
+
+
+def win_masks(size, length=None):
+    "Every line of length stones (default: a whole row) on a size x size board"
+    if length is None:
+        length = size
+    masks = []
+    for row in range(size):
+        for col in range(size):
+            for drow, dcol in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                end_row = row + drow * (length - 1)
+                end_col = col + dcol * (length - 1)
+                if not (0 <= end_row < size and 0 <= end_col < size):
+                    continue
+                mask = 0
+                for i in range(length):
+                    mask |= 1 << ((row + drow * i) * size + col + dcol * i)
+                masks.append(mask)
+    return tuple(masks)
+
+
+# WINNING[mask] is 1 when mask contains a complete line
+WINNING = bytes(any(mask & line == line for line in WIN_MASKS) for mask in range(FULL + 1))
+
+
+def result_of(x, o):
+    "Decide a position from the two masks, a win always beats a full board"
+    if WINNING[x]:
+        return X_WINS
+    if WINNING[o]:
+        return O_WINS
+    if x | o == FULL:
+        return DRAW
+    return ONGOING
+
+
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+class Board:
+    "One game: the two player masks and the authoritative result"
+
+    __slots__ = ('x', 'o', 'result', 'size', 'length', 'cells', 'full')
+
+    def __init__(self, x=0, o=0, size=3, length=None):
+        self.x = x
+        self.o = o
+        self.size = size
+        self.length = size if length is None else length
+        self.cells = size * size
+        self.full = (1 << self.cells) - 1
+        if self.classic():
+            self.result = result_of(x, o)
+        else:
+            self.result = self.scan()
+
+    def copy(self):
+        "A second board in the same position, without deciding it again"
+        board = Board.__new__(Board)
+        board.x = self.x
+        board.o = self.o
+        board.result = self.result
+        board.size = self.size
+        board.length = self.length
+        board.cells = self.cells
+        board.full = self.full
+        return board
+
+    def classic(self):
+        "The plain 3x3 game, decided by the WINNING table"
+        return self.size == 3 and self.length == 3
+
+    def scan(self):
+        "Decide a position from scratch, only needed when a game is set up"
+        for side, mask in ((X, self.x), (O, self.o)):
+            for cell in range(self.cells):
+                if mask >> cell & 1 and self.wins_through(mask, cell):
+                    return X_WINS + side
+        return DRAW if self.x | self.o == self.full else ONGOING
+
+    def wins_through(self, mask, cell):
+        """Whether mask holds length stones in a row through cell. Only the
+        four lines through cell are walked, at most length - 1 steps each way"""
+        size = self.size
+        length = self.length
+        row, col = divmod(cell, size)
+        for drow, dcol in DIRECTIONS:
+            count = 1
+            r, c = row + drow, col + dcol
+            while count < length and 0 <= r < size and 0 <= c < size and mask >> (r * size + c) & 1:
+                count += 1
+                r += drow
+                c += dcol
+            r, c = row - drow, col - dcol
+            while count < length and 0 <= r < size and 0 <= c < size and mask >> (r * size + c) & 1:
+                count += 1
+                r -= drow
+                c -= dcol
+            if count >= length:
+                return True
+        return False
+
+    def to_move(self):
+        "x moves first, so o is to move whenever x has played one more stone"
+        return O if bin(self.x).count('1') > bin(self.o).count('1') else X
+
+    def is_free(self, cell):
+        return not (self.x | self.o) >> cell & 1
+
+    def free_cells(self):
+        taken = self.x | self.o
+        return [cell for cell in range(self.cells) if not taken >> cell & 1]
+
+    def illegal(self, cell, side):
+        "Why side may not play cell now, 0 when the move is fine"
+        if self.result != ONGOING:
+            return GAME_OVER
+        if side != self.to_move():
+            return NOT_YOUR_TURN
+        if not 0 <= cell < self.cells or not self.is_free(cell):
+            return BAD_CELL
+        return 0
+
+    def play(self, cell, side=None):
+        "Place a stone for side (default: the side to move) and return the result"
+        if self.result != ONGOING:
+            raise ValueError("the game is already over")
+        if not 0 <= cell < self.cells or not self.is_free(cell):
+            raise ValueError("cell %r is not free" % (cell,))
+        if side is None:
+            side = self.to_move()
+        bit = 1 << cell
+        # only the mover can have completed a line, and only through this stone
+        if side == X:
+            self.x |= bit
+            mask = self.x
+        else:
+            self.o |= bit
+            mask = self.o
+        if WINNING[mask] if self.classic() else self.wins_through(mask, cell):
+            self.result = X_WINS + side
+        elif self.x | self.o == self.full:
+            self.result = DRAW
+        return self.result
+
+    def to_bytes(self):
+        "Compact snapshot: size, length, then both masks little endian"
+        width = (self.cells + 7) // 8
+        return (bytes((self.size, self.length))
+                + self.x.to_bytes(width, 'little') + self.o.to_bytes(width, 'little'))
+
+    @classmethod
+    def from_bytes(cls, data):
+        size, length = data[0], data[1]
+        width = (size * size + 7) // 8
+        x = int.from_bytes(data[2:2 + width], 'little')
+        o = int.from_bytes(data[2 + width:2 + 2 * width], 'little')
+        return cls(x, o, size, length)
+
+    def __repr__(self):
+        rows = []
+        for row in range(self.size):
+            cells = []
+            for cell in range(row * self.size, (row + 1) * self.size):
+                if self.x >> cell & 1:
+                    cells.append('x')
+                elif self.o >> cell & 1:
+                    cells.append('o')
+                else:
+                    cells.append('.')
+            rows.append(''.join(cells))
+        return 'Board(%s)' % '/'.join(rows)
+
+
+if __name__ == '__main__':
+    import timeit
+
+    n = 1000000
+    t = timeit.timeit('result_of(0b100010001, 0b000101010)', globals=globals(), number=n)
+    print("result_of: %.0f evaluations/sec" % (n / t))
+    gomoku = Board(size=15, length=5)
+    for cell in (112, 0, 113, 1, 114, 2, 115, 3):
+        gomoku.play(cell)
+    n = 100000
+    t = timeit.timeit('gomoku.wins_through(gomoku.x, 115)', globals=globals(), number=n)
+    print("15x15 five in a row: %.0f move checks/sec" % (n / t))
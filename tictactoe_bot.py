@@ -0,0 +1,286 @@
+"""
+Alpha-beta computer opponent for Tic Tac Toe on NxN boards.
+
+The search is negamax with alpha-beta pruning. Positions are stored in a
+transposition table under a symmetry-reduced key: a board and its 7
+rotations/reflections have the same value, so the table keeps one entry for
+all eight. The key of a position is
+
+    x | o << cells
+
+with both player masks packed in one integer, and its canonical form is the
+smallest of the 8 transformed keys. Transforming a key is done with lookup
+tables, one per 8-bit chunk of the key, instead of moving the bits one by
+one.
+
+On 3x3 the table stays warm between moves, so after the first search every
+decision is a handful of table hits. Larger boards cannot be searched to
+the end; iterative deepening runs until the time or node budget is spent
+and the last completed depth decides, leaves are scored by counting open
+lines.
+
+    bot = AlphaBetaBot()
+    cell = bot.choose(board.x, board.o, board.to_move())
+
+A search takes as long as its budget, and the caller waits for it. An
+event loop serving other matches cannot; BotPool runs the searches in
+worker processes, each with an AlphaBetaBot of its own, and submit()
+returns a concurrent.futures.Future at once.
+"""
+
+import concurrent.futures
+import os
+import time
+
+from tictactoe_board import X, win_masks
+
+WIN = 1000000
+EXACT, LOWER, UPPER = 0, 1, 2
+FULL_DEPTH = 1 << 30
+MAX_TABLE = 1 << 20
+
+
+class OutOfBudget(Exception):
+    "The time or node budget ran out in the middle of a search"
+
+
+def symmetries(size):
+    "The 8 rotations and reflections of the square, as cell permutations"
+    perms = []
+    for t in range(8):
+        perm = []
+        for cell in range(size * size):
+            row, col = divmod(cell, size)
+            if t & 4:
+                row, col = col, row
+            if t & 1:
+                row = size - 1 - row
+            if t & 2:
+                col = size - 1 - col
+            perm.append(row * size + col)
+        perms.append(perm)
+    return perms
+
+
+def chunk_tables(perm, bits):
+    "Lookup tables that apply a bit permutation one byte of the key at a time"
+    tables = []
+    for start in range(0, bits, 8):
+        table = []
+        for byte in range(256):
+            out = 0
+            for i in range(8):
+                if byte >> i & 1 and start + i < bits:
+                    out |= 1 << perm[start + i]
+            table.append(out)
+        tables.append(table)
+    return tables
+
+
+class AlphaBetaBot:
+    "Negamax with alpha-beta, a transposition table and symmetry reduction"
+
+    def __init__(self, size=3, length=None, time_budget=None, node_budget=None):
+        self.size = size
+        self.cells = size * size
+        self.full = (1 << self.cells) - 1
+        self.time_budget = time_budget
+        self.node_budget = node_budget
+        self.lines = win_masks(size, length)
+        # only the lines through the last stone can have been completed by it
+        self.lines_through = [[line for line in self.lines if line >> cell & 1]
+                              for cell in range(self.cells)]
+        # try the middle of the board first, it makes the cutoffs come early
+        center = (size - 1) / 2
+        self.order = sorted(range(self.cells),
+                            key=lambda cell: abs(cell // size - center) + abs(cell % size - center))
+        # the key packs both masks, o's bits sit above x's
+        key_perms = [perm + [cell + self.cells for cell in perm] for perm in symmetries(size)]
+        self.transforms = [chunk_tables(perm, 2 * self.cells) for perm in key_perms]
+        self.table = {}
+        self.nodes = 0
+        self.deadline = None
+
+    def canonical(self, x, o):
+        key = x | o << self.cells
+        best = key
+        for tables in self.transforms:
+            out = 0
+            shifted = key
+            for table in tables:
+                out |= table[shifted & 255]
+                shifted >>= 8
+            if out < best:
+                best = out
+        return best
+
+    def evaluate(self, me, opp):
+        "Open lines weighted by how many stones they already hold"
+        score = 0
+        for line in self.lines:
+            if not line & opp:
+                score += 1 << (2 * bin(line & me).count('1'))
+            elif not line & me:
+                score -= 1 << (2 * bin(line & opp).count('1'))
+        return score
+
+    def wins(self, mask, cell):
+        for line in self.lines_through[cell]:
+            if mask & line == line:
+                return True
+        return False
+
+    def tick(self):
+        self.nodes += 1
+        if self.node_budget is not None and self.nodes > self.node_budget:
+            raise OutOfBudget
+        if self.deadline is not None and not self.nodes & 1023 and time.perf_counter() > self.deadline:
+            raise OutOfBudget
+
+    def negamax(self, me, opp, depth, alpha, beta):
+        "Value of the position for the side to move, whose stones are me"
+        self.tick()
+        empty = self.full & ~(me | opp)
+        if not empty:
+            return 0
+        remaining = bin(empty).count('1')
+        if depth >= remaining:
+            depth = FULL_DEPTH  # the search reaches the end, the value is exact
+        elif depth == 0:
+            return self.evaluate(me, opp)
+        # positions are keyed with x's mask first whoever is to move
+        if remaining % 2 == self.cells % 2:
+            key = self.canonical(me, opp)
+        else:
+            key = self.canonical(opp, me)
+        entry = self.table.get(key)
+        if entry is not None and entry[0] >= depth:
+            _, flag, value = entry
+            if flag == EXACT:
+                return value
+            if flag == LOWER and value > alpha:
+                alpha = value
+            elif flag == UPPER and value < beta:
+                beta = value
+            if alpha >= beta:
+                return value
+        alpha_orig = alpha
+        best = -WIN * (self.cells + 1)
+        for cell in self.order:
+            bit = 1 << cell
+            if not empty & bit:
+                continue
+            if self.wins(me | bit, cell):
+                # a quicker win leaves more empty cells and scores higher
+                score = WIN * remaining
+            else:
+                score = -self.negamax(opp, me | bit, depth - 1, -beta, -alpha)
+            if score > best:
+                best = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+        if best <= alpha_orig:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        if len(self.table) >= MAX_TABLE:
+            self.table.clear()
+        self.table[key] = (depth, flag, best)
+        return best
+
+    def search_root(self, me, opp, depth, first):
+        empty = self.full & ~(me | opp)
+        moves = [cell for cell in self.order if empty >> cell & 1]
+        if first is not None:
+            moves.remove(first)
+            moves.insert(0, first)
+        best_cell, alpha = moves[0], -WIN * (self.cells + 1)
+        for cell in moves:
+            bit = 1 << cell
+            if self.wins(me | bit, cell):
+                return cell
+            score = -self.negamax(opp, me | bit, depth - 1, -WIN * (self.cells + 1), -alpha)
+            if score > alpha:
+                best_cell, alpha = cell, score
+        return best_cell
+
+    def choose(self, x, o, side=X):
+        "Best cell for side in the position given by the two masks"
+        me, opp = (x, o) if side == X else (o, x)
+        empty = self.full & ~(me | opp)
+        if not empty:
+            raise ValueError("the board is full")
+        remaining = bin(empty).count('1')
+        self.nodes = 0
+        self.deadline = None
+        if self.time_budget is not None:
+            self.deadline = time.perf_counter() + self.time_budget
+        # without a budget there is nothing to deepen towards, search to the end
+        if self.time_budget is None and self.node_budget is None:
+            depths = [remaining]
+        else:
+            depths = range(1, remaining + 1)
+        best = None
+        try:
+            for depth in depths:
+                best = self.search_root(me, opp, depth, best)
+        except OutOfBudget:
+            pass
+        if best is None:
+            # not even depth 1 finished, take the most central free cell
+            best = next(cell for cell in self.order if empty >> cell & 1)
+        return best
+
+
+worker_bot = None  # the AlphaBetaBot of a BotPool worker process
+
+
+def start_worker(size, length, time_budget):
+    global worker_bot
+    worker_bot = AlphaBetaBot(size, length, time_budget)
+
+
+def choose_in_worker(x, o, side):
+    return worker_bot.choose(x, o, side)
+
+
+class BotPool:
+    "AlphaBetaBot searches in worker processes, for callers that cannot wait for them"
+
+    def __init__(self, size=3, length=None, time_budget=None, workers=None):
+        self.size = size
+        self.length = length
+        self.time_budget = time_budget
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None  # started with the first search, in the process that searches
+
+    def submit(self, x, o, side=X):
+        "Future of the best cell for side"
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                self.workers, initializer=start_worker, initargs=(self.size, self.length, self.time_budget))
+        return self.pool.submit(choose_in_worker, x, o, side)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+
+if __name__ == '__main__':
+    bot = AlphaBetaBot()
+    started = time.perf_counter()
+    bot.choose(0, 0)
+    print("first 3x3 move: %.1f ms, %d positions" % ((time.perf_counter() - started) * 1000, len(bot.table)))
+    started = time.perf_counter()
+    for _ in range(1000):
+        bot.choose(1 << 4, 0, side=1)
+    print("warm 3x3 move: %.1f us" % ((time.perf_counter() - started) * 1000))
+    big = AlphaBetaBot(size=7, length=4, time_budget=0.5)
+    started = time.perf_counter()
+    cell = big.choose(0, 0)
+    print("7x7 four in a row: cell %d after %.0f ms" % (cell, (time.perf_counter() - started) * 1000))
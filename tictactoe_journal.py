@@ -0,0 +1,205 @@
+"""
+Append-only binary journal of Tic Tac Toe matches.
+
+Every start, move and result is one fixed size record of 20 bytes:
+
+    match   I   match id
+    seq     I   move number in the match, 0 for start and result
+    kind    B   REC_START, REC_MOVE or REC_RESULT
+    side    B   the player of the record (0 x, 1 o)
+    cell    H   cell of a move / result of the game / size << 8 | length
+    time    Q   microseconds since the epoch
+
+little endian, after an 8 byte file header. Records are never changed,
+only added at the end.
+
+Journal is the writing side. append() only packs the record into a
+buffer; write() hands the buffer to the kernel in one os.write, and sync()
+fsyncs, so a server can write often (the bytes become visible to readers)
+and pay for fsync once per batch instead of once per move.
+
+JournalReader is the reading side, for analytics and for spectators that
+join a running match. It memory-maps the file and reads the records with
+struct.iter_unpack straight out of the map, no text is parsed. It keeps
+an index match id -> record offsets and only scans what was appended since
+its last refresh(), so catching up on a match costs the records of that
+match, not the whole file. It never talks to the server.
+
+    python tictactoe_journal.py games.journal          (summary)
+    python tictactoe_journal.py games.journal 42       (replay match 42)
+"""
+
+import mmap
+import os
+import struct
+import sys
+import time
+
+from tictactoe_board import Board, DRAW, MARKS, X_WINS
+
+MAGIC = b'TTJ1\0\0\0\0'
+RECORD = struct.Struct('<IIBBHQ')
+
+REC_START, REC_MOVE, REC_RESULT = 1, 2, 3
+
+
+def now_us():
+    return time.time_ns() // 1000
+
+
+class Journal:
+    "Buffered appender, records reach the file on write() and the disk on sync()"
+
+    def __init__(self, path, batch=256):
+        self.path = path
+        self.batch = batch  # records buffered before append() writes by itself
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size == 0:
+            os.write(self.fd, MAGIC)
+        self.buffer = bytearray()
+        self.pending = 0
+        self.unsynced = False
+
+    def append(self, match, seq, kind, side, cell, stamp=None):
+        self.buffer += RECORD.pack(match, seq, kind, side, cell, now_us() if stamp is None else stamp)
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.write()
+
+    def start(self, match, size, length):
+        self.append(match, 0, REC_START, 0, size << 8 | length)
+
+    def move(self, match, seq, side, cell):
+        self.append(match, seq, REC_MOVE, side, cell)
+
+    def result(self, match, result):
+        self.append(match, 0, REC_RESULT, 0, result)
+
+    def write(self):
+        "One system call for everything buffered"
+        if self.buffer:
+            os.write(self.fd, self.buffer)
+            self.buffer.clear()
+            self.pending = 0
+            self.unsynced = True
+
+    def sync(self):
+        "fsync whatever was written since the last sync"
+        if self.unsynced:
+            self.unsynced = False
+            os.fsync(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            self.write()
+            self.sync()
+            os.close(self.fd)
+            self.fd = None
+
+
+def next_match_id(path):
+    "A match id above every id already in the journal at path"
+    if not os.path.exists(path):
+        return 1
+    reader = JournalReader(path)
+    try:
+        return max(reader.index, default=0) + 1
+    finally:
+        reader.close()
+
+
+class JournalReader:
+    "Memory-mapped view of a journal with a per match index"
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.view = None
+        self.scanned = len(MAGIC)
+        self.index = {}  # match id -> offsets of its records
+        self.refresh()
+
+    def refresh(self):
+        "Map the file again if it grew and index the new records only"
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(MAGIC):
+                return
+            size -= (size - len(MAGIC)) % RECORD.size  # a record still being written
+            if self.map is not None and size <= len(self.map):
+                return
+            if self.view is not None:
+                self.view.release()
+                self.map.close()
+            self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a tic tac toe journal" % self.path)
+        offset = self.scanned
+        index = self.index
+        for record in RECORD.iter_unpack(self.view[self.scanned:size]):
+            index.setdefault(record[0], []).append(offset)
+            offset += RECORD.size
+        self.scanned = size
+
+    def records(self):
+        "Every record in file order"
+        return RECORD.iter_unpack(self.view[len(MAGIC):self.scanned])
+
+    def match_records(self, match):
+        return [RECORD.unpack_from(self.view, offset) for offset in self.index.get(match, ())]
+
+    def catch_up(self, match):
+        """The board of a match as far as the journal has it, with the last
+        move number, e.g. for a spectator joining in the middle"""
+        board = None
+        last_seq = 0
+        for _, seq, kind, side, cell, stamp in self.match_records(match):
+            if kind == REC_START:
+                board = Board(size=cell >> 8, length=cell & 255)
+            elif kind == REC_MOVE and board is not None:
+                board.play(cell, side)
+                last_seq = seq
+        return board, last_seq
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.map.close()
+            self.view = self.map = None
+
+
+def summary(reader):
+    matches = moves = finished = 0
+    results = [0, 0, 0, 0]
+    for _, seq, kind, side, cell, stamp in reader.records():
+        if kind == REC_START:
+            matches += 1
+        elif kind == REC_MOVE:
+            moves += 1
+        elif kind == REC_RESULT:
+            finished += 1
+            results[cell] += 1
+    print("%d matches, %d finished, %d moves" % (matches, finished, moves))
+    print("x wins %d, o wins %d, draws %d" % (results[X_WINS], results[X_WINS + 1], results[DRAW]))
+
+
+def replay(reader, match):
+    for _, seq, kind, side, cell, stamp in reader.match_records(match):
+        when = time.strftime('%H:%M:%S', time.localtime(stamp / 1e6))
+        if kind == REC_START:
+            print("%s start %dx%d, %d in a row" % (when, cell >> 8, cell >> 8, cell & 255))
+        elif kind == REC_MOVE:
+            print("%s #%d %s -> cell %d" % (when, seq, MARKS[side], cell))
+        elif kind == REC_RESULT:
+            print("%s %s" % (when, "draw" if cell == DRAW else "%s wins" % MARKS[cell - X_WINS]))
+    board, last_seq = reader.catch_up(match)
+    print(board)
+
+
+if __name__ == '__main__':
+    reader = JournalReader(sys.argv[1])
+    if len(sys.argv) > 2:
+        replay(reader, int(sys.argv[2]))
+    else:
+        summary(reader)
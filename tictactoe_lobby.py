@@ -0,0 +1,104 @@
+"""
+Lobby of players waiting for an opponent.
+
+Players are queued by rating bucket, rating // bucket_width, first come
+first served inside a bucket. Without a bucket width everybody lands in
+bucket 0 and the lobby is a plain FIFO queue.
+
+An arrival is paired at once with the longest waiting player of its own
+bucket, else with the one of the nearest non-empty bucket at most reach
+buckets away; only when there is nobody it waits itself. Looking up the
+neighbours is a bisect in the sorted list of non-empty buckets, and a
+bucket is a deque. A bucket that fills or empties is inserted into or
+deleted from that list, which shifts the keys after it, so an arrival
+costs O(b) for b buckets in use, a memmove of b pointers, and does not
+depend on how many players are waiting.
+
+Players who leave the lobby some other way (they hung up, or were given to
+the bot) are not searched for: remove() only marks them, and marked
+players are thrown away when they reach the front of their bucket.
+
+    lobby = Lobby(bucket_width=100)
+    opponent = lobby.add(player, rating=1500)   # None: player waits
+"""
+
+import bisect
+import collections
+
+DEFAULT_RATING = 1500
+
+
+class Lobby:
+    "Waiting players in FIFO queues, one per rating bucket"
+
+    def __init__(self, bucket_width=None, reach=1):
+        self.bucket_width = bucket_width  # None: one queue for everybody
+        self.reach = reach  # how many buckets up or down an opponent may be
+        self.buckets = {}  # bucket -> deque of waiting players
+        self.keys = []  # sorted buckets that have somebody in them
+        self.waiting = 0
+
+    def bucket_of(self, rating):
+        if self.bucket_width is None:
+            return 0
+        return rating // self.bucket_width
+
+    def front(self, key):
+        "The longest waiting player of a bucket, forgetting the bucket once it is empty"
+        queue = self.buckets[key]
+        while queue and (queue[0].closed or queue[0].queued is None):
+            queue.popleft()
+        if queue:
+            return queue[0]
+        del self.buckets[key]
+        del self.keys[bisect.bisect_left(self.keys, key)]
+        return None
+
+    def nearest(self, key):
+        "The bucket to take an opponent from, or None"
+        if key in self.buckets and self.front(key) is not None:
+            return key
+        while True:
+            i = bisect.bisect_left(self.keys, key)
+            below = self.keys[i - 1] if i > 0 else None
+            above = self.keys[i] if i < len(self.keys) else None
+            if below is not None and key - below > self.reach:
+                below = None
+            if above is not None and above - key > self.reach:
+                above = None
+            if below is None and above is None:
+                return None
+            # the closer bucket, the lower one on a tie
+            if above is None or below is not None and key - below <= above - key:
+                pick = below
+            else:
+                pick = above
+            if self.front(pick) is not None:
+                return pick
+
+    def add(self, player, rating=DEFAULT_RATING):
+        "Pair player with a waiting opponent and return it, or queue player and return None"
+        key = self.bucket_of(rating)
+        pick = self.nearest(key)
+        if pick is not None:
+            opponent = self.buckets[pick].popleft()
+            opponent.queued = None
+            self.waiting -= 1
+            return opponent
+        queue = self.buckets.get(key)
+        if queue is None:
+            queue = self.buckets[key] = collections.deque()
+            bisect.insort(self.keys, key)
+        queue.append(player)
+        player.queued = key
+        self.waiting += 1
+        return None
+
+    def remove(self, player):
+        "Take player out of the lobby, it is dropped lazily from its queue"
+        if player.queued is not None:
+            player.queued = None
+            self.waiting -= 1
+
+    def __len__(self):
+        return self.waiting
@@ -0,0 +1,183 @@
+"""
+Monte Carlo tree search player for large Tic Tac Toe boards.
+
+Alpha-beta cannot see far on 15x15 five in a row. MCTS instead grows a
+tree of the moves that did well in random playouts (UCT selection) and
+plays the move that was explored most.
+
+The search is parallelised at the root: every worker process of a
+concurrent.futures.ProcessPoolExecutor runs its own tree from the same
+position with its own random seed until the wall-clock budget is spent,
+and returns the visit and win counts of the root moves. The counts of all
+workers are added up. The workers share nothing while they search, so the
+number of rollouts grows with the number of cores.
+
+    bot = MCTSBot(size=15, length=5, time_budget=1.0, workers=4)
+    cell = bot.choose(board.x, board.o, board.to_move())
+    bot.close()
+
+Run the module to measure rollouts/sec against the number of workers in
+self-play:
+    python tictactoe_mcts.py --size 15 --length 5 --budget 1 --workers 1 2 4
+"""
+
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import random
+import time
+
+from tictactoe_board import Board, DRAW, ONGOING, X, X_WINS
+
+EXPLORATION = 1.4
+
+
+class Node:
+    "A move in the search tree, wins are counted for the side that made it"
+
+    __slots__ = ('move', 'parent', 'side', 'untried', 'children', 'visits', 'wins')
+
+    def __init__(self, move, parent, side, untried):
+        self.move = move
+        self.parent = parent
+        self.side = side
+        self.untried = untried
+        self.children = []
+        self.visits = 0
+        self.wins = 0.0
+
+    def select(self):
+        "The child with the best UCB1 score"
+        log_visits = math.log(self.visits)
+        best, best_score = None, -1.0
+        for child in self.children:
+            score = child.wins / child.visits + EXPLORATION * math.sqrt(log_visits / child.visits)
+            if score > best_score:
+                best, best_score = child, score
+        return best
+
+
+def search(x, o, size, length, budget, seed):
+    """One independent UCT search, this is what runs in every worker.
+    Returns {move: (visits, wins)} for the root moves and the rollout count"""
+    rng = random.Random(seed)
+    start = Board(x, o, size, length)
+    root = Node(None, None, 1 - start.to_move(), start.free_cells())
+    deadline = time.perf_counter() + budget
+    rollouts = 0
+    while time.perf_counter() < deadline:
+        board = start.copy()
+        node = root
+        # selection: walk down while every move of the node has a child
+        while not node.untried and node.children:
+            node = node.select()
+            board.play(node.move, node.side)
+        # expansion: add one untried move
+        if node.untried and board.result == ONGOING:
+            move = node.untried.pop(rng.randrange(len(node.untried)))
+            side = 1 - node.side
+            board.play(move, side)
+            child = Node(move, node, side, board.free_cells() if board.result == ONGOING else [])
+            node.children.append(child)
+            node = child
+        # rollout: random moves to the end of the game
+        if board.result == ONGOING:
+            free = board.free_cells()
+            rng.shuffle(free)
+            side = 1 - node.side
+            for cell in free:
+                if board.play(cell, side) != ONGOING:
+                    break
+                side = 1 - side
+        result = board.result
+        # backpropagation
+        while node is not None:
+            node.visits += 1
+            if result == DRAW:
+                node.wins += 0.5
+            elif result == X_WINS + node.side:
+                node.wins += 1.0
+            node = node.parent
+        rollouts += 1
+    return {child.move: (child.visits, child.wins) for child in root.children}, rollouts
+
+
+class MCTSBot:
+    "Root parallel MCTS, one tree per worker process, merged visit counts"
+
+    def __init__(self, size=15, length=5, time_budget=1.0, workers=None):
+        self.size = size
+        self.length = length
+        self.time_budget = time_budget
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.rng = random.Random()
+        self.last_rollouts = 0
+
+    def choose(self, x, o, side=X):
+        "Most visited root move over all workers; side is implied by the position"
+        seeds = [self.rng.getrandbits(64) for _ in range(self.workers)]
+        if self.workers == 1:
+            results = [search(x, o, self.size, self.length, self.time_budget, seeds[0])]
+        else:
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+            futures = [self.pool.submit(search, x, o, self.size, self.length, self.time_budget, seed)
+                       for seed in seeds]
+            results = [future.result() for future in futures]
+        visits = {}
+        self.last_rollouts = 0
+        for stats, rollouts in results:
+            self.last_rollouts += rollouts
+            for move, (count, wins) in stats.items():
+                visits[move] = visits.get(move, 0) + count
+        if not visits:
+            raise ValueError("no move to make")
+        return max(visits, key=visits.get)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def self_play(size, length, budget, workers, moves):
+    "Play the first moves of a game against itself, return rollouts/sec"
+    bot = MCTSBot(size, length, budget, workers)
+    try:
+        bot.choose(0, 0)  # starts the worker processes outside of the timing
+        board = Board(size=size, length=length)
+        rollouts = 0
+        started = time.perf_counter()
+        for _ in range(moves):
+            if board.result != ONGOING:
+                break
+            board.play(bot.choose(board.x, board.o, board.to_move()))
+            rollouts += bot.last_rollouts
+        elapsed = time.perf_counter() - started
+    finally:
+        bot.close()
+    return rollouts / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MCTS self-play rollout benchmark")
+    parser.add_argument('--size', type=int, default=15)
+    parser.add_argument('--length', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=1.0, help="seconds per move")
+    parser.add_argument('--moves', type=int, default=4, help="self-play moves per worker count")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args(argv)
+    report = []
+    for workers in args.workers:
+        rate = self_play(args.size, args.length, args.budget, workers, args.moves)
+        report.append({'workers': workers, 'rollouts_per_sec': round(rate, 1),
+                       'speedup': round(rate / report[0]['rollouts_per_sec'], 2) if report else 1.0})
+    print(json.dumps({'size': args.size, 'length': args.length, 'budget_sec': args.budget,
+                      'cpus': os.cpu_count(), 'runs': report}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Length prefixed binary protocol for the Tic Tac Toe socket link.
+
+The tkinter scripts send single letters and read them back with
+recv(2048), so two moves that arrive in one TCP segment ('ab') match none
+of the letters and are lost. TCP is a byte stream, a message needs its own
+boundaries. Every frame here is:
+
+    length  H   number of bytes that follow the length field
+    type    B   MSG_* below
+    game    I   match id
+    seq     I   sequence number of the move
+    cell    H   board cell (or side / result, depending on type)
+    payload     length - 11 bytes, empty for most messages
+
+all in network byte order. FrameDecoder keeps unfinished bytes in one
+reusable bytearray, so a frame split over two reads or several frames in
+one read are both decoded correctly. FrameBuffer collects outgoing frames
+so a batch leaves in a single send call.
+
+Frames are at most MAX_FRAME bytes, so the first byte of a frame is never
+one of the letters 'a'..'i' (that would need a length of 24832 and more).
+A server can look at the first byte and still serve the letter clients.
+
+A Limiter holds two token buckets per connection, one for messages and one
+for bytes. Every read is charged to the byte bucket before any of it is
+decoded, and its frames to the message bucket before any is handled. A
+bucket costs one subtraction per read and has no timer: it is refilled
+from the time since its last use. A peer that empties a bucket gets
+RateLimited and is disconnected, so a flood costs the server one
+comparison per read instead of decoding and checking every frame.
+
+One connection can carry many matches. MSG_CHANNEL is an envelope: its
+cell is a channel number chosen by the client and its payload is one or
+more complete frames of that channel, e.g. a MSG_JOIN, later the moves.
+Everything the server has for the channel comes back in MSG_CHANNEL
+envelopes with the same number, and an envelope with no payload closes
+the channel (either way). A bot or a dashboard that plays or watches a
+hundred boards needs one socket, not a hundred. split_frames() cuts the
+queued frames of a channel into envelope payloads.
+"""
+
+import struct
+import time
+
+MSG_JOIN = 1    # client -> server: I speak this protocol, put me in a match,
+                #   cell is my rating, 0 when I have none, payload is my
+                #   name in utf-8 (at most NAME_SIZE bytes) or empty
+MSG_START = 2   # server -> client: match started, cell is your side (0 x, 1 o),
+                #   payload is board size and win length, one byte each,
+                #   then the TOKEN_SIZE byte session token for MSG_RESUME
+MSG_MOVE = 3    # both ways: a stone on cell
+MSG_ACK = 4     # server -> client: your move seq was accepted
+MSG_RESULT = 5  # server -> client: game over, cell is the result
+MSG_ERROR = 6   # server -> client: move seq was refused, cell is the reason
+MSG_WATCH = 7   # client -> server: send me the moves of match game
+MSG_SNAPSHOT = 8  # server -> client: the whole board of match game after move
+                  #   seq, cell is the result, payload is Board.to_bytes()
+MSG_RESUME = 9  # client -> server: I lost the link, put me back in match game,
+                #   payload is the session token of its MSG_START
+MSG_CHANNEL = 10  # both ways: the frames in payload belong to channel cell,
+                  #   no payload closes the channel
+
+NO_MATCH = 16   # MSG_ERROR reason: there is no such match (any more)
+
+TOKEN_SIZE = 16
+NAME_SIZE = 32
+
+PREFIX = struct.Struct('!H')
+HEADER = struct.Struct('!BIIH')
+FRAME = struct.Struct('!HBIIH')
+
+MAX_FRAME = 1 << 14  # a snapshot of a 255x255 board still fits
+MAX_ENVELOPE = MAX_FRAME - FRAME.size  # frames carried by one MSG_CHANNEL
+
+
+class ProtocolError(Exception):
+    "The peer sent bytes that are not a valid frame"
+
+
+class RateLimited(ProtocolError):
+    "The peer sent more than its token bucket allows"
+
+
+class TokenBucket:
+    "rate tokens a second, at most burst of them saved up"
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, count, now):
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        if tokens < count:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - count
+        return True
+
+
+class Limiter:
+    "Message and byte buckets of one connection, a rate of 0 is no limit"
+
+    def __init__(self, message_rate, byte_rate, burst_seconds=2.0):
+        now = time.monotonic()
+        self.message_rate = message_rate
+        self.byte_rate = byte_rate
+        self.burst_seconds = burst_seconds
+        self.messages = TokenBucket(message_rate, message_rate * burst_seconds, now) if message_rate else None
+        self.bytes = TokenBucket(byte_rate, byte_rate * burst_seconds, now) if byte_rate else None
+        self.now = now
+
+    def read(self, data):
+        "Charge one read, before a single byte of it is decoded"
+        self.now = time.monotonic()
+        if self.bytes is not None and not self.bytes.take(len(data), self.now):
+            raise RateLimited("more than %d bytes/s" % self.bytes.rate)
+
+    def frames(self, count):
+        "Charge the frames of the last read, before any of them is handled"
+        if self.messages is not None and not self.messages.take(count, self.now):
+            raise RateLimited("more than %d messages/s" % self.messages.rate)
+
+    def share(self, channels):
+        "Scale the budget for a connection serving channels, the caller bounds the count"
+        for bucket, rate in ((self.messages, self.message_rate), (self.bytes, self.byte_rate)):
+            if bucket is not None:
+                bucket.rate = rate * max(channels, 1)
+                bucket.burst = bucket.rate * self.burst_seconds
+
+
+def encode(msg_type, game=0, seq=0, cell=0, payload=b''):
+    "Build one frame"
+    if payload:
+        return FRAME.pack(HEADER.size + len(payload), msg_type, game, seq, cell) + payload
+    return FRAME.pack(HEADER.size, msg_type, game, seq, cell)
+
+
+class FrameBuffer:
+    "Collects outgoing frames so a whole batch is written with one send call"
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data)
+
+    def add(self, msg_type, game=0, seq=0, cell=0, payload=b''):
+        self.data += FRAME.pack(HEADER.size + len(payload), msg_type, game, seq, cell)
+        if payload:
+            self.data += payload
+
+    def take(self):
+        "Return the queued bytes and start a new batch"
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+    def flush(self, sock):
+        if self.data:
+            sock.sendall(self.data)
+            self.data.clear()
+
+
+def unpack_frames(buf):
+    """The complete frames at the start of buf as (type, game, seq, cell,
+    payload) tuples, and the number of bytes they take"""
+    frames = []
+    pos = 0
+    end = len(buf)
+    while end - pos >= PREFIX.size:
+        (length,) = PREFIX.unpack_from(buf, pos)
+        if length < HEADER.size or length + PREFIX.size > MAX_FRAME:
+            raise ProtocolError("bad frame length %d" % length)
+        if end - pos - PREFIX.size < length:
+            break  # the rest of this frame is still on the way
+        msg_type, game, seq, cell = HEADER.unpack_from(buf, pos + PREFIX.size)
+        start = pos + FRAME.size
+        pos += PREFIX.size + length
+        payload = bytes(buf[start:pos]) if pos > start else b''
+        frames.append((msg_type, game, seq, cell, payload))
+    return frames, pos
+
+
+def unpack_envelope(payload):
+    "The frames of a MSG_CHANNEL payload, which holds only whole frames"
+    frames, used = unpack_frames(payload)
+    if used != len(payload):
+        raise ProtocolError("unfinished frame in a channel envelope")
+    return frames
+
+
+def split_frames(data, limit=MAX_ENVELOPE):
+    "Cut encoded frames into pieces of at most limit bytes, never inside a frame"
+    view = memoryview(data)
+    start = pos = 0
+    while pos < len(data):
+        (length,) = PREFIX.unpack_from(data, pos)
+        if pos > start and pos + PREFIX.size + length - start > limit:
+            yield view[start:pos]
+            start = pos
+        pos += PREFIX.size + length
+    if pos > start:
+        yield view[start:pos]
+
+
+class FrameDecoder:
+    "Turns a stream of reads into frames, whatever the read boundaries are"
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add the bytes of one read and return the complete frames as
+        (type, game, seq, cell, payload) tuples"""
+        buf = self.buffer
+        buf += data
+        frames, pos = unpack_frames(buf)
+        # keep only the unfinished tail, the bytearray itself is reused
+        if pos:
+            del buf[:pos]
+        return frames
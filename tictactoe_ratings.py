@@ -0,0 +1,311 @@
+"""
+Elo and Glicko ratings of every player from the whole match history.
+
+Needs numpy. The matches come from the results store of
+tictactoe_results.py, or from the record file of a tournament made by
+tictactoe_tournament.py, and are taken in the order they were played.
+
+Elo proper moves one game at a time, every update waits for the one
+before, so it cannot be done with whole arrays. Ratings here are computed
+per rating period instead, as Glicko is defined: all games of a period
+are rated against the ratings the players had at its start, and the
+period is a handful of numpy operations over its games, whatever their
+number. np.unique numbers the players of the period, np.bincount adds
+up their expected and actual scores, and only those players' entries of
+the rating arrays are read and written. The periods themselves are a
+Python loop, so ten million matches in a few thousand periods are rated
+in seconds.
+
+Elo is the classic k = 32 update for a player with up to ten games in a
+period; beyond that its step in the period is cut so that the gap between
+two players can close but never go past the one their results call for,
+and long periods or short ones end up at about the same Elo. Glicko is
+the published update, which is made for periods of a few games per
+player; long periods of lopsided games make it swing.
+
+A player who sits out periods is not touched by them: the growth of its
+rating deviation, RD^2 + c^2 per period since it last played, is applied
+when it plays again, which is the same as growing it every period.
+
+The ratings are kept in the results store, in the ratings table, with the
+last period they include. A full recompute (--full) rates every match
+from the start. The default is incremental: it starts from the kept
+ratings and rates only the matches of the periods after them, and writes
+only the players who played in those. Ratings are kept up to the last
+period that is over, so the period still running is rated again on the
+next update, with the results that come in meanwhile, and the ratings
+are the same as those of a full recompute. Only a result stored after
+its period was over and kept is left out until the next --full.
+
+    python tictactoe_ratings.py tictactoe.results            (incremental, top 10)
+    python tictactoe_ratings.py tictactoe.results --full --period 3600
+    python tictactoe_ratings.py tournament.ttr --period 1000 (periods of 1000 games)
+    python tictactoe_ratings.py --check                      (the updates settle on draws)
+"""
+
+import argparse
+import math
+import time
+
+import numpy as np
+
+from tictactoe_board import DRAW, X_WINS
+from tictactoe_results import connect
+from tictactoe_tournament import MAGIC as TOURNAMENT_MAGIC, RECORD as TOURNAMENT_RECORD, read_header
+
+INITIAL = 1500.0
+INITIAL_RD = 350.0
+K = 32.0
+C = 34.6  # RD 50 grows back to 350 after 100 periods without a game
+PERIOD = 86400.0  # seconds, a day
+
+Q = math.log(10) / 400
+
+# score of x for X_WINS, O_WINS and DRAW
+SCORE = np.array([np.nan, 1.0, 0.0, 0.5])
+
+RATINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ratings (
+    player INTEGER PRIMARY KEY REFERENCES players,
+    elo REAL NOT NULL,
+    glicko REAL NOT NULL,
+    rd REAL NOT NULL,
+    period INTEGER NOT NULL,
+    games INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS ratings_glicko ON ratings (glicko DESC);
+CREATE TABLE IF NOT EXISTS rating_periods (
+    length REAL NOT NULL,
+    rated INTEGER NOT NULL);
+"""
+
+
+class Ratings:
+    "Elo, Glicko rating and deviation of players 0..n-1, as arrays"
+
+    def __init__(self, players=0):
+        self.elo = np.full(players, INITIAL)
+        self.glicko = np.full(players, INITIAL)
+        self.rd = np.full(players, INITIAL_RD)
+        self.period = np.zeros(players, dtype=np.int64)  # last period played in
+        self.games = np.zeros(players, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.elo)
+
+    def grow(self, players):
+        "Room for players up to players - 1, the new ones unrated"
+        extra = players - len(self)
+        if extra > 0:
+            self.elo = np.concatenate((self.elo, np.full(extra, INITIAL)))
+            self.glicko = np.concatenate((self.glicko, np.full(extra, INITIAL)))
+            self.rd = np.concatenate((self.rd, np.full(extra, INITIAL_RD)))
+            self.period = np.concatenate((self.period, np.zeros(extra, dtype=np.int64)))
+            self.games = np.concatenate((self.games, np.zeros(extra, dtype=np.int64)))
+
+    def rate_period(self, period, x, o, score, k=K, c=C):
+        """Rate the games of one period: x and o are the players of every
+        game, score what x made of it. Returns the players who played"""
+        players, local = np.unique(np.concatenate((x, o)), return_inverse=True)
+        count = len(players)
+        lx, lo = local[:len(x)], local[len(x):]
+        # elo, every game against the ratings at the start of the period. A
+        # player with many games in the period would overshoot by k per game:
+        # the expected score moves at most q / 4 a rating point, and both
+        # players of a game move, so a gap closes by up to k q / 2 of itself
+        # per game. The step is cut by that, a gap can reach its target but
+        # never go past it
+        games = np.bincount(local, minlength=count)
+        elo = self.elo[players]
+        expected = 1 / (1 + 10 ** ((elo[lo] - elo[lx]) / 400))
+        delta = k * (score - expected)
+        step = np.maximum(1, k * Q * games / 2)
+        self.elo[players] = elo + (np.bincount(lx, delta, count) - np.bincount(lo, delta, count)) / step
+        # glicko, the deviation grown by the periods each player sat out
+        rating = self.glicko[players]
+        rd = np.minimum(np.sqrt(self.rd[players] ** 2 + c * c * (period - self.period[players])),
+                        INITIAL_RD)
+        g = 1 / np.sqrt(1 + 3 * Q * Q * rd * rd / math.pi ** 2)
+        ex = 1 / (1 + 10 ** (-g[lo] * (rating[lx] - rating[lo]) / 400))
+        eo = 1 / (1 + 10 ** (-g[lx] * (rating[lo] - rating[lx]) / 400))
+        variance = (np.bincount(lx, g[lo] ** 2 * ex * (1 - ex), count)
+                    + np.bincount(lo, g[lx] ** 2 * eo * (1 - eo), count))
+        improvement = (np.bincount(lx, g[lo] * (score - ex), count)
+                       + np.bincount(lo, g[lx] * (1 - score - eo), count))
+        precision = 1 / (rd * rd) + Q * Q * variance
+        self.glicko[players] = rating + Q / precision * improvement
+        self.rd[players] = np.sqrt(1 / precision)
+        self.period[players] = period
+        self.games[players] += games
+        return players
+
+    def rate(self, periods, x, o, results, k=K, c=C):
+        """Rate matches ordered by period, returns every player who played.
+        The arrays hold one entry per match"""
+        if not len(periods):
+            return np.zeros(0, dtype=np.int64)
+        self.grow(int(max(x.max(), o.max())) + 1)
+        score = SCORE[results]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(periods)) + 1, [len(periods)]))
+        touched = []
+        for start, end in zip(starts[:-1], starts[1:]):
+            touched.append(self.rate_period(int(periods[start]), x[start:end], o[start:end],
+                                            score[start:end], k, c))
+        return np.unique(np.concatenate(touched))
+
+
+def check(periods=20):
+    """Two players who only draw each other, after a first period that put
+    them far apart, must come together without their order flipping: Elo
+    at any number of games per period, Glicko at a few. Raises
+    AssertionError if they do not"""
+    for games in (1, 2, 10, 100, 1000):
+        ratings = Ratings(3)
+        # 0 beats 2 and 2 beats 1 twenty times
+        ratings.rate(np.zeros(40, dtype=np.int64), np.tile([0, 2], 20), np.tile([2, 1], 20),
+                     np.full(40, X_WINS))
+        for name in ('elo', 'glicko') if games <= 2 else ('elo',):
+            values = getattr(ratings, name)
+            assert values[0] > values[1], (name, games, values)
+        elo_gap = glicko_gap = None
+        for period in range(1, periods * (50 if games <= 2 else 1) + 1):
+            sides = np.tile([0, 1], games)[:games]
+            ratings.rate(np.full(games, period), sides, 1 - sides, np.full(games, DRAW))
+            gap = ratings.elo[0] - ratings.elo[1]
+            assert gap >= 0 and (elo_gap is None or gap <= elo_gap + 1e-9), ('elo', games, period, gap, elo_gap)
+            elo_gap = gap
+            if games <= 2:
+                glicko_gap = ratings.glicko[0] - ratings.glicko[1]
+        assert elo_gap < 5, ('elo', games, elo_gap)
+        assert glicko_gap is None or abs(glicko_gap) < 25, ('glicko', games, glicko_gap)
+
+
+def load_matches(db, since=0.0):
+    "finished, x, o and result of the stored matches finished at since or later, in the order they were played"
+    rows = np.fromiter(db.execute("SELECT finished, x, o, result FROM matches WHERE finished >= ?", (since,)),
+                       dtype=[('finished', 'f8'), ('x', 'i8'), ('o', 'i8'), ('result', 'u1')])
+    # in rowid order the scan is sequential, sorting it here is cheaper than sqlite's index walk
+    rows = rows[np.argsort(rows['finished'], kind='stable')]
+    return rows['finished'], rows['x'], rows['o'], rows['result']
+
+
+def load_tournament(path):
+    "Names and the x, o and result arrays of a tournament record file, one read and no per-game Python"
+    with open(path, 'rb') as f:
+        data = f.read()
+    names, size, length, pos = read_header(data, path)
+    end = pos + (len(data) - pos) // TOURNAMENT_RECORD.size * TOURNAMENT_RECORD.size
+    records = np.frombuffer(data, dtype=[('game', '<u4'), ('x', 'u1'), ('o', 'u1'),
+                                         ('result', 'u1'), ('moves', '<u2')],
+                            count=(end - pos) // TOURNAMENT_RECORD.size, offset=pos)
+    # the chunks come back in any order, the game numbers are the order of play
+    records = records[np.argsort(records['game'], kind='stable')]
+    return names, records['game'], records['x'].astype(np.int64), records['o'].astype(np.int64), records['result']
+
+
+def read_state(db):
+    "The kept ratings, the period length and the last period they include"
+    db.executescript(RATINGS_SCHEMA)
+    row = db.execute("SELECT length, rated FROM rating_periods").fetchone()
+    if row is None:
+        return Ratings(), None, None
+    rows = np.array(db.execute("SELECT player, elo, glicko, rd, period, games FROM ratings").fetchall(),
+                    dtype=np.float64).reshape(-1, 6)
+    ratings = Ratings(int(rows[:, 0].max()) + 1 if len(rows) else 0)
+    player = rows[:, 0].astype(np.int64)
+    ratings.elo[player] = rows[:, 1]
+    ratings.glicko[player] = rows[:, 2]
+    ratings.rd[player] = rows[:, 3]
+    ratings.period[player] = rows[:, 4].astype(np.int64)
+    ratings.games[player] = rows[:, 5].astype(np.int64)
+    return ratings, row[0], row[1]
+
+
+def write_state(db, ratings, players, length, rated, full):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if full:
+            db.execute("DELETE FROM ratings")
+        db.executemany("INSERT OR REPLACE INTO ratings (player, elo, glicko, rd, period, games) "
+                       "VALUES (?, ?, ?, ?, ?, ?)",
+                       zip(players.tolist(), ratings.elo[players].tolist(), ratings.glicko[players].tolist(),
+                           ratings.rd[players].tolist(), ratings.period[players].tolist(),
+                           ratings.games[players].tolist()))
+        db.execute("DELETE FROM rating_periods")
+        db.execute("INSERT INTO rating_periods (length, rated) VALUES (?, ?)", (length, rated))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+
+def update(path, period=PERIOD, full=False, now=None):
+    """Bring the kept ratings of a results store up to date and return them
+    with the number of matches rated and the players they changed"""
+    db = connect(path)
+    try:
+        ratings, length, rated = read_state(db)
+        if full or length != period:
+            ratings, rated = Ratings(), -1  # a new period length means new periods
+            full = True
+        current = int((time.time() if now is None else now) // period)
+        finished, x, o, results = load_matches(db, (rated + 1) * period)
+        periods = (finished // period).astype(np.int64)
+        # the periods that are over are kept, the running one is rated again next time
+        closed = int(np.searchsorted(periods, current))
+        kept = ratings.rate(periods[:closed], x[:closed], o[:closed], results[:closed])
+        write_state(db, ratings, kept, period, current - 1, full)
+        changed = np.union1d(kept, ratings.rate(periods[closed:], x[closed:], o[closed:], results[closed:]))
+        ratings.grow(int(db.execute("SELECT coalesce(max(id), 0) FROM players").fetchone()[0]) + 1)
+        return ratings, len(periods), changed
+    finally:
+        db.close()
+
+
+def names_of(path):
+    db = connect(path)
+    try:
+        return dict(db.execute("SELECT id, name FROM players"))
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Elo and Glicko ratings from the match history")
+    parser.add_argument('path', nargs='?', help="results store, or a tournament .ttr file")
+    parser.add_argument('--full', action='store_true', help="rate every match again from the start")
+    parser.add_argument('--period', type=float, default=None,
+                        help="rating period, seconds for a store (default a day), games for a tournament")
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--check', action='store_true',
+                        help="check that players who only draw each other end up close together")
+    args = parser.parse_args(argv)
+    if args.check:
+        check()
+        print("draws bring the ratings together")
+        return
+    if args.path is None:
+        parser.error("a results store or tournament file is needed")
+    started = time.perf_counter()
+    with open(args.path, 'rb') as f:
+        tournament = f.read(len(TOURNAMENT_MAGIC)) == TOURNAMENT_MAGIC
+    if tournament:
+        names, games, x, o, results = load_tournament(args.path)
+        ratings = Ratings(len(names))
+        ratings.rate(games // int(args.period or 1000), x, o, results)
+        names = dict(enumerate(names))
+        matches = len(games)
+    else:
+        ratings, matches, changed = update(args.path, args.period or PERIOD, args.full)
+        names = names_of(args.path)
+    elapsed = time.perf_counter() - started
+    print("%d matches rated in %.2f s" % (matches, elapsed))
+    played = np.flatnonzero(ratings.games)
+    best = played[np.argsort(-ratings.glicko[played], kind='stable')][:args.limit]
+    for player in best:
+        print("%-20s glicko %6.0f +- %3.0f  elo %6.0f  %d games" % (
+            names.get(int(player), player), ratings.glicko[player], 2 * ratings.rd[player],
+            ratings.elo[player], ratings.games[player]))
+
+
+if __name__ == '__main__':
+    main()
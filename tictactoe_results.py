@@ -0,0 +1,255 @@
+"""
+Finished matches in SQLite, for leaderboards and match history.
+
+The journal of tictactoe_journal.py keeps every move but answers only
+"what happened in match N". This store keeps one row per finished match:
+
+    matches   id, finished (unix time), x, o (player ids), result,
+              moves, size, length, game (the server's match id)
+    players   id, name, wins, losses, draws, last (unix time)
+
+ResultStore is the writing side. record() puts the result on a queue and
+returns; a writer thread takes everything queued, up to batch results,
+and commits it in one transaction, so the game loop never waits for the
+disk and the database sees one fsync per batch instead of one per match.
+The database is in WAL mode: readers never block the writer nor the
+writer the readers, and several server processes can write to one file.
+The counters of the players table are updated in the same transaction as
+the matches, so the leaderboard is read off its index and never adds up
+the matches.
+
+ResultReader is the reading side, a read-only connection:
+  - leaderboard(): the top players by wins, then draws, from the
+    players_rank index,
+  - history(name): a player's latest matches, newest first. There is an
+    index on (x, finished) and one on (o, finished); each side is read
+    from its index in order and stops at the limit, so the cost is the
+    limit, not the number of matches the player has played,
+  - recent(): the latest matches of everybody, from the finished index.
+All three stay around a millisecond at tens of millions of matches.
+
+    python tictactoe_results.py tictactoe.results            (leaderboard)
+    python tictactoe_results.py tictactoe.results alice      (alice's matches)
+    python tictactoe_results.py big.results --fill 10000000  (random matches to try the queries on)
+"""
+
+import argparse
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+from tictactoe_board import DRAW, MARKS, O_WINS, X_WINS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    draws INTEGER NOT NULL DEFAULT 0,
+    last REAL);
+CREATE INDEX IF NOT EXISTS players_rank ON players (wins DESC, draws DESC);
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    finished REAL NOT NULL,
+    x INTEGER NOT NULL REFERENCES players,
+    o INTEGER NOT NULL REFERENCES players,
+    result INTEGER NOT NULL,
+    moves INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    game INTEGER);
+CREATE INDEX IF NOT EXISTS matches_finished ON matches (finished);
+CREATE INDEX IF NOT EXISTS matches_x ON matches (x, finished);
+CREATE INDEX IF NOT EXISTS matches_o ON matches (o, finished);
+"""
+
+MATCH_COLUMNS = "m.finished, px.name, po.name, m.result, m.moves, m.size, m.length, m.game"
+
+STOP = None
+
+
+def connect(path, timeout=30.0):
+    "A connection in WAL mode, the schema created if the file is new"
+    db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent, only fsyncs at checkpoints
+    db.executescript(SCHEMA)
+    return db
+
+
+class ResultStore:
+    "Queues results and commits them in batches from a writer thread"
+
+    def __init__(self, path, batch=1000):
+        self.path = path
+        self.batch = batch  # results per transaction at most
+        self.queue = queue.SimpleQueue()
+        self.written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.writer, name="results", daemon=True)
+        self.thread.start()
+
+    def record(self, x, o, result, moves, size=3, length=3, game=None, finished=None):
+        "Queue one finished match between the players named x and o, never blocks"
+        if self.error is None:
+            self.queue.put((time.time() if finished is None else finished, x, o, result, moves,
+                            size, length, game))
+
+    def writer(self):
+        ids = {}  # player name -> id, players are never deleted
+        db = None
+        try:
+            db = connect(self.path)
+            while True:
+                results = [self.queue.get()]
+                # whatever else is queued goes in the same transaction
+                while results[-1] is not STOP and len(results) < self.batch:
+                    try:
+                        results.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = results[-1] is STOP
+                if stop:
+                    results.pop()
+                if results:
+                    self.commit(db, ids, results)
+                if stop:
+                    return
+        except sqlite3.Error as e:
+            self.error = e  # results from now on are lost, close() raises it
+        finally:
+            if db is not None:
+                db.close()
+
+    def commit(self, db, ids, results):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            names = {name for result in results for name in result[1:3] if name not in ids}
+            if names:
+                db.executemany("INSERT OR IGNORE INTO players (name) VALUES (?)", [(n,) for n in names])
+                for name in names:
+                    ids[name] = db.execute("SELECT id FROM players WHERE name = ?", (name,)).fetchone()[0]
+            rows = []
+            counts = {}  # player id -> [wins, losses, draws, last]
+            for finished, x, o, result, moves, size, length, game in results:
+                x, o = ids[x], ids[o]
+                rows.append((finished, x, o, result, moves, size, length, game))
+                for player, won, lost in ((x, X_WINS, O_WINS), (o, O_WINS, X_WINS)):
+                    count = counts.setdefault(player, [0, 0, 0, 0.0])
+                    count[0] += result == won
+                    count[1] += result == lost
+                    count[2] += result == DRAW
+                    count[3] = max(count[3], finished)
+            db.executemany("INSERT INTO matches (finished, x, o, result, moves, size, length, game) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            # one update per player and batch, however many matches it played in it
+            db.executemany("UPDATE players SET wins = wins + ?, losses = losses + ?, draws = draws + ?, "
+                           "last = max(coalesce(last, 0), ?) WHERE id = ?",
+                           [(w, l, d, last, player) for player, (w, l, d, last) in counts.items()])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        self.written += len(results)
+
+    def close(self):
+        "Write everything queued so far and stop the writer"
+        if self.thread is not None:
+            self.queue.put(STOP)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+
+
+class ResultReader:
+    "Leaderboard and history queries on a read-only connection"
+
+    def __init__(self, path):
+        self.db = sqlite3.connect('file:%s?mode=ro' % path, uri=True, timeout=30.0)
+
+    def leaderboard(self, limit=10):
+        "(name, wins, losses, draws) of the best limit players"
+        return self.db.execute("SELECT name, wins, losses, draws FROM players "
+                               "ORDER BY wins DESC, draws DESC LIMIT ?", (limit,)).fetchall()
+
+    def history(self, name, limit=20, before=None):
+        """The latest limit matches of a player, newest first, as
+        (finished, x, o, result, moves, size, length, game). Pass the
+        finished time of the last row as before to get the next page"""
+        row = self.db.execute("SELECT id FROM players WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return []
+        before = float('inf') if before is None else before
+        side = ("SELECT * FROM (SELECT " + MATCH_COLUMNS + " FROM matches m "
+                "JOIN players px ON px.id = m.x JOIN players po ON po.id = m.o "
+                "WHERE m.%s = ? AND m.finished < ? ORDER BY m.finished DESC LIMIT ?)")
+        return self.db.execute(side % 'x' + " UNION ALL " + side % 'o' + " ORDER BY 1 DESC LIMIT ?",
+                               (row[0], before, limit, row[0], before, limit, limit)).fetchall()
+
+    def recent(self, limit=20):
+        "The latest limit matches of everybody, newest first"
+        return self.db.execute("SELECT " + MATCH_COLUMNS + " FROM matches m "
+                               "JOIN players px ON px.id = m.x JOIN players po ON po.id = m.o "
+                               "ORDER BY m.finished DESC LIMIT ?", (limit,)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def fill(path, count, players=10000, seed=None):
+    "count random matches between players made up players, to try the queries on"
+    rng = random.Random(seed)
+    store = ResultStore(path, batch=100000)
+    start = time.time() - count  # one match a second up to now
+    results = (X_WINS, O_WINS, DRAW)
+    for i in range(count):
+        x, o = rng.sample(range(players), 2)
+        store.record('player%d' % x, 'player%d' % o, rng.choice(results), rng.randint(5, 9),
+                     finished=start + i)
+    store.close()
+    return store.written
+
+
+def describe(row):
+    finished, x, o, result, moves, size, length, game = row
+    when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(finished))
+    outcome = "draw" if result == DRAW else "%s wins" % MARKS[result - X_WINS]
+    return "%s  %s (x) - %s (o)  %s after %d moves  %dx%d" % (when, x, o, outcome, moves, size, size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tic Tac Toe leaderboard and match history")
+    parser.add_argument('path')
+    parser.add_argument('name', nargs='?', help="show the matches of this player")
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--fill', type=int, default=None, metavar='MATCHES',
+                        help="first add this many random matches")
+    args = parser.parse_args(argv)
+    if args.fill:
+        started = time.perf_counter()
+        written = fill(args.path, args.fill)
+        print("%d matches written in %.1f s" % (written, time.perf_counter() - started))
+    reader = ResultReader(args.path)
+    try:
+        started = time.perf_counter()
+        if args.name:
+            rows = reader.history(args.name, args.limit)
+        else:
+            rows = reader.leaderboard(args.limit)
+        elapsed = time.perf_counter() - started
+        for row in rows:
+            if args.name:
+                print(describe(row))
+            else:
+                print("%-20s %6d wins %6d losses %6d draws" % row)
+        print("(%.2f ms)" % (elapsed * 1000))
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,969 @@
+"""
+Headless Tic Tac Toe server built on asyncio.
+
+Tic-Tac-Toe-Server.py hosts exactly one match: it accepts one client and
+hands the socket to a single handler thread. This module runs many matches
+in one process: every connection is paired by the lobby of
+tictactoe_lobby.py and the two sockets form an independent match. There is no thread per socket,
+all connections are served by one event loop.
+
+Two wire protocols are understood, told apart by the first byte a client
+sends:
+  - the single letter protocol of the tkinter scripts, 'a'..'i' for the
+    nine cells, so old clients keep working. A connection that sends a
+    letter, or nothing at all for LEGACY_WAIT seconds, is such a client
+    and is paired right away. A silent one that sends a frame after all
+    is taken back as binary, unless a move went out to it as a letter,
+  - the framed binary protocol of tictactoe_protocol.py. Such clients
+    send MSG_JOIN to be paired (its cell is their rating, 0 when they
+    have none), get MSG_START with their side and the
+    board setting, and every accepted MSG_MOVE is answered with MSG_ACK.
+The two can play each other, moves are re-encoded for the receiver.
+
+A binary client can send MSG_WATCH instead of MSG_JOIN to follow a running
+match. It gets a MSG_SNAPSHOT of the board, then every move. A move is
+encoded once and the same bytes are queued for every spectator, after
+the two players have been served. A spectator may have at most
+SPECTATOR_BUFFER bytes waiting; when it falls behind it gets nothing more
+until it has read most of them, then one snapshot replaces all the moves
+it missed. One that stays behind for SPECTATOR_MAX_LAG seconds is
+disconnected, so a slow reader never holds up the match.
+
+MSG_START carries a session token. A binary player whose connection drops
+keeps its seat for RESUME_WINDOW seconds: it reconnects, sends MSG_RESUME
+with the match id and the token, and gets one MSG_SNAPSHOT of the board
+(two bitmasks and the move count, a few bytes whatever the length of the
+game) instead of the moves it missed. After the window the match is given
+up and the opponent disconnected, as it was for letter clients at once.
+
+The server owns the one board of every match. A move is checked against
+it (the game is on, it is the mover's turn, the cell is free) before it
+reaches the other player; a refused move gets MSG_ERROR with the reason
+from tictactoe_board (letter clients are just ignored). When the game is
+decided both players get MSG_RESULT once and the match is closed, so the
+clients only have to draw what they are told.
+
+A binary client may put many matches on one connection: every MSG_CHANNEL
+envelope it sends is handled as if its frames came over a connection of
+their own, one Channel per channel number, and the answers go back in
+envelopes of that channel. The channels share the socket fairly: what
+they queue is written at once while the socket keeps up, and when more
+than MUX_HIGH_WATER bytes wait in the transport, the channels take turns
+with MUX_QUANTUM bytes per round (deficit round robin) until it drains,
+so one busy channel, e.g. a spectator getting snapshots, cannot hold up
+the moves of the others. A channel is closed with the match it served;
+the client opens it again with its next MSG_JOIN. Only a MSG_JOIN,
+MSG_WATCH or MSG_RESUME opens a channel, frames still in flight for one
+the server closed are dropped. Channels of one
+connection always stay on the worker that accepted it, see --workers.
+
+Every connection gets a Limiter: --max-messages and --max-bytes per second
+(twice that as a burst) are charged before its reads are decoded, and a
+connection that sends more is closed. A connection with channels open
+may send that much for each of them, but never more than CHANNEL_SHARE
+connections' worth, and a channel whose MSG_WATCH or MSG_RESUME found no
+match is closed at once, so channels cannot be opened to buy budget.
+
+--results FILE keeps every finished match, with the names of its players,
+in the SQLite store of tictactoe_results.py for leaderboards and history.
+A binary client names itself in the payload of MSG_JOIN, anybody else is
+known by its IP address. The results are committed in batches by a
+writer thread, the event loop only queues them.
+
+--journal FILE records every start, move and result in the binary journal
+of tictactoe_journal.py. Records are written to the file every
+--journal-sync seconds and fsynced in a worker thread right after, so the
+event loop never waits for the disk.
+
+--size and --length set up larger games, e.g. --size 15 --length 5 for
+five in a row. Cells are numbered row * size + col; only the binary
+protocol can carry cells past 'i', so on any other board a letter client
+is refused as soon as its first letter arrives, and a silent connection
+is never taken for one.
+
+The lobby pairs players first come first served. With --buckets WIDTH it
+keeps one queue per rating // WIDTH and looks for an opponent in the
+arrival's bucket, then up to --reach buckets away. A match starts as soon
+as its second player arrives; with --bot-after SECONDS a player who is
+still waiting after that long plays the bot instead.
+
+--workers N runs N copies of the server in forked processes under the
+supervisor of server_common.py, all listening on the same port with
+SO_REUSEPORT, so the matches are spread over N cores (--workers 0 runs one
+per CPU). Every worker pairs
+the connections the kernel gave it and a match never leaves the worker it
+was made in. A binary player still without an opponent after
+HANDOFF_AFTER seconds is passed on to worker 0: its socket is sent over a
+unix datagram socket (SCM_RIGHTS) with its rating, and worker 0 serves it
+from then on, so the last players of every worker can still meet. A
+MSG_RESUME that reaches another worker than the one of its match is
+passed on the same way. Match ids are handed out with a stride of N, and MSG_WATCH only finds the
+matches of the worker the spectator got connected to, as does MSG_RESUME on a channel.
+
+With --bot nobody waits for an opponent: every connection plays the
+alpha-beta bot of tictactoe_bot.py as o. Its searches run in the worker
+processes of a BotPool: the player's move is acknowledged at once, the
+loop goes on serving every other match while the bot thinks, and the
+bot's move is played when its search is done. --table points the bot at
+a file made by tictactoe_table.py instead, every bot move is then one
+lookup in the memory-mapped table, made right away.
+
+Run it with:
+    python tictactoe_server.py --port 6000
+or  python Tic-Tac-Toe-Server.py --headless
+"""
+
+import argparse
+import array
+import asyncio
+import collections
+import itertools
+import os
+import signal
+import socket
+import struct
+import time
+
+from server_common import HEARTBEAT, Supervisor, beat, raise_fd_limit
+from tictactoe_board import Board, ONGOING
+from tictactoe_bot import BotPool
+from tictactoe_journal import Journal, next_match_id
+from tictactoe_lobby import DEFAULT_RATING, Lobby
+from tictactoe_protocol import (FrameBuffer, FrameDecoder, Limiter, ProtocolError, encode, NO_MATCH,
+                                MSG_ACK, MSG_CHANNEL, MSG_ERROR, MSG_JOIN, MSG_MOVE, MSG_RESULT, MSG_RESUME,
+                                MSG_SNAPSHOT, MSG_START, MSG_WATCH, NAME_SIZE, TOKEN_SIZE, split_frames,
+                                unpack_envelope)
+from tictactoe_results import ResultStore
+from tictactoe_table import PerfectPlayTable
+
+HOST = '127.0.0.1'
+PORT = 6000
+LETTERS = b'abcdefghi'
+CELL_OF_LETTER = {letter: cell for cell, letter in enumerate(LETTERS)}
+
+LEGACY_WAIT = 0.2
+SPECTATOR_BUFFER = 64 * 1024
+SPECTATOR_LOW = SPECTATOR_BUFFER // 4
+SPECTATOR_MAX_LAG = 5.0
+HANDOFF_AFTER = 0.05
+HANDOFF = struct.Struct('!HIB')  # rating, match id, length of the name that follows, then the token of a resume
+RESUME_WINDOW = 30.0
+MAX_CHANNELS = 1024  # per connection
+CHANNEL_SHARE = 4  # rate limits of this many connections at most for one with channels
+CHANNEL_OPENERS = {MSG_JOIN, MSG_WATCH, MSG_RESUME}  # the frames a new channel may start with
+MUX_QUANTUM = 4096  # bytes a channel may write per round when the socket is behind
+MUX_HIGH_WATER = 64 * 1024
+
+
+class Player:
+    "One connected socket"
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.match = None
+        self.side = None
+        self.binary = None  # unknown until the first bytes arrive
+        self.silent = False  # taken for a letter client only because nothing arrived
+        self.decoder = None
+        self.out = FrameBuffer()
+        self.joined = False
+        self.queued = None  # the lobby bucket while waiting for an opponent
+        self.rating = DEFAULT_RATING
+        self.name = None  # for the results, see GameServer.connect
+        self.idle = None  # timer that hands a waiting player to the bot
+        self.watching = None  # the match a spectator follows
+        self.lagging_since = None
+        self.limiter = None
+        self.channels = None  # number -> Channel once the client multiplexes
+        self.scheduler = None
+        self.closed = False
+
+    def send(self, data):
+        # small writes go straight to the transport buffer, no drain needed
+        if not self.closed:
+            self.writer.write(data)
+
+    def send_move(self, game, seq, cell):
+        if self.binary:
+            self.out.add(MSG_MOVE, game, seq, cell)
+        elif cell < len(LETTERS):
+            self.send(LETTERS[cell:cell + 1])
+
+    def backlog(self):
+        "Bytes queued here and in the transport that the peer has not read yet"
+        return len(self.out) + self.writer.transport.get_write_buffer_size()
+
+    def flush(self):
+        "Write every queued frame with one call"
+        if self.out:
+            self.send(self.out.take())
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class Channel(Player):
+    "One match or spectator seat on a multiplexed connection"
+
+    def __init__(self, conn, number):
+        super().__init__(conn.reader, conn.writer)
+        self.conn = conn
+        self.number = number
+        self.name = conn.name
+        self.binary = True
+        self.envelopes = collections.deque()  # written when it is our turn
+        self.pending = 0  # bytes in envelopes
+        self.deficit = 0
+        self.active = False  # in the scheduler's round
+
+    def backlog(self):
+        return len(self.out) + self.pending
+
+    def flush(self):
+        if self.out and not self.closed:
+            self.conn.scheduler.add(self, self.out.take())
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.conn.channels.get(self.number) is self:
+                del self.conn.channels[self.number]
+                if self.conn.limiter is not None:
+                    self.conn.limiter.share(min(len(self.conn.channels), CHANNEL_SHARE))
+            if not self.conn.closed:
+                self.conn.scheduler.add(self, b'')  # tells the client the channel is closed
+
+
+class Scheduler:
+    "Deficit round robin over the channels of one connection"
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.active = collections.deque()  # channels with envelopes waiting
+        self.scheduled = False
+        self.draining = None
+
+    def add(self, channel, frames):
+        "Queue the frames of channel, all the channels of this loop pass leave in one write"
+        number = channel.number
+        if frames:
+            envelopes = [encode(MSG_CHANNEL, 0, 0, number, piece) for piece in split_frames(frames)]
+        else:
+            envelopes = [encode(MSG_CHANNEL, 0, 0, number)]
+        for envelope in envelopes:
+            channel.envelopes.append(envelope)
+            channel.pending += len(envelope)
+        if not channel.active:
+            channel.active = True
+            self.active.append(channel)
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.pump)
+
+    def pump(self):
+        self.scheduled = False
+        conn = self.conn
+        if conn.closed or self.draining is not None:
+            return
+        transport = conn.writer.transport
+        data = bytearray()
+        while self.active and transport.get_write_buffer_size() + len(data) < MUX_HIGH_WATER:
+            channel = self.active.popleft()
+            channel.deficit += MUX_QUANTUM
+            envelopes = channel.envelopes
+            while envelopes and len(envelopes[0]) <= channel.deficit:
+                envelope = envelopes.popleft()
+                channel.deficit -= len(envelope)
+                channel.pending -= len(envelope)
+                data += envelope
+            if envelopes:
+                self.active.append(channel)
+            else:
+                channel.deficit = 0
+                channel.active = False
+        if data:
+            conn.send(data)
+        if self.active:
+            # the socket is behind, the rest waits for it in turns
+            self.draining = asyncio.create_task(self.drain())
+
+    async def drain(self):
+        try:
+            await self.conn.writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            self.draining = None
+        self.pump()
+
+
+class BotPlayer:
+    "Computer opponent living inside the server, searches off the event loop"
+
+    binary = False
+    name = 'bot'
+
+    def __init__(self, server, engine):
+        self.server = server
+        self.engine = engine
+        self.match = None
+        self.side = None
+        self.seq = 0
+        self.closed = False
+
+    def send_move(self, game, seq, cell):
+        # the move is already on the match board, which the bot reads too
+        board = self.match.board
+        if board.result != ONGOING:
+            return
+        if isinstance(self.engine, BotPool):
+            # the search starts after the player's ack has been written
+            asyncio.get_running_loop().call_soon(self.think)
+        else:
+            self.seq += 1
+            self.server.move(self, self.seq, self.engine.choose(board.x, board.o, self.side))
+
+    def think(self):
+        board = self.match.board
+        if not self.closed and board.result == ONGOING:
+            future = asyncio.wrap_future(self.engine.submit(board.x, board.o, self.side))
+            future.add_done_callback(self.answer)
+
+    def answer(self, future):
+        "The search is done, play its move unless the match is over by now"
+        match = self.match
+        if future.cancelled() or self.closed or match.match_id not in self.server.matches:
+            return
+        if future.exception() is not None:
+            self.server.end(match)  # the pool is broken, nobody would answer
+        else:
+            self.seq += 1
+            self.server.move(self, self.seq, future.result())
+        self.server.flush_dirty()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Match:
+    "Two players sharing one board"
+
+    def __init__(self, match_id, first, second, board):
+        self.match_id = match_id
+        self.board = board
+        self.moves = 0
+        self.spectators = set()
+        self.players = [first, second]  # a resumed player takes the seat of its old connection
+        self.tokens = (os.urandom(TOKEN_SIZE), os.urandom(TOKEN_SIZE))
+        self.timers = [None, None]  # gives a seat up when its player does not come back
+        for side, player in enumerate(self.players):
+            player.match = self
+            player.side = side
+
+    def opponent(self, player):
+        first, second = self.players
+        return second if player is first else first
+
+
+class GameServer:
+    "Pairs incoming connections into matches and routes moves per match"
+
+    def __init__(self, bot=None, size=3, length=None, journal=None, first_match_id=1,
+                 lobby=None, bot_after=None, shard=0, shards=1, handoff=None, limits=None, results=None):
+        self.bot = bot  # a BotPool or table shared by all bot matches, or None
+        self.bot_after = bot_after  # None: the bot takes everybody right away
+        self.size = size
+        self.length = size if length is None else length
+        self.journal = journal
+        self.results = results  # a ResultStore or None
+        self.limits = limits  # (messages, bytes) a second per connection, None for no limit
+        self.lobby = Lobby() if lobby is None else lobby
+        self.matches = {}
+        self.match_ids = itertools.count(first_match_id, shards)
+        self.first_match_id = first_match_id
+        self.sessions = {}  # token -> match
+        self.shard = shard
+        self.shards = shards
+        self.handoff = handoff  # unix socket address of the workers, without the shard
+        self.handoff_socket = None
+        self.tasks = set()
+        self.handlers = set()  # the tasks of start_server serving a connection
+        self.dirty = set()
+        self.dirty_spectators = set()
+        self.closing = []
+
+    def pair(self, player, rating=DEFAULT_RATING):
+        if self.bot is not None and self.bot_after is None:
+            # the human moves first as x, the bot answers as o
+            return self.begin(player, BotPlayer(self, self.bot))
+        opponent = self.lobby.add(player, rating)
+        if opponent is None:
+            player.rating = rating
+            if self.handoff is not None and self.shard != 0 and player.binary and not isinstance(player, Channel):
+                player.idle = asyncio.get_running_loop().call_later(HANDOFF_AFTER, self.hand_off, player)
+            elif self.bot is not None:
+                player.idle = asyncio.get_running_loop().call_later(self.bot_after, self.idle, player)
+            return None
+        if opponent.idle is not None:
+            opponent.idle.cancel()
+            opponent.idle = None
+        return self.begin(opponent, player)
+
+    def idle(self, player):
+        "Nobody came for player in time, the bot plays it"
+        player.idle = None
+        if player.queued is not None and not player.closed:
+            self.lobby.remove(player)
+            self.begin(player, BotPlayer(self, self.bot))
+            self.flush_dirty()
+
+    def begin(self, first, second):
+        match = Match(next(self.match_ids), first, second,
+                      Board(size=self.size, length=self.length))
+        self.matches[match.match_id] = match
+        if self.journal is not None:
+            self.journal.start(match.match_id, self.size, self.length)
+        for each in match.players:
+            if each.binary:
+                self.sessions[match.tokens[each.side]] = match
+                self.start(each)
+        return match
+
+    def start(self, player):
+        match = player.match
+        player.out.add(MSG_START, match.match_id, 0, player.side,
+                       bytes((self.size, self.length)) + match.tokens[player.side])
+        self.dirty.add(player)
+
+    def move(self, player, seq, cell):
+        match = player.match
+        if match is None:
+            return  # no opponent yet, the game has not started
+        board = match.board
+        reason = board.illegal(cell, player.side)
+        if reason:
+            # refused here, the opponent never sees it
+            if player.binary:
+                player.out.add(MSG_ERROR, match.match_id, seq, reason)
+                self.dirty.add(player)
+            return
+        result = board.play(cell, player.side)
+        match.moves += 1
+        if self.journal is not None:
+            self.journal.move(match.match_id, match.moves, player.side, cell)
+        if player.binary:
+            player.out.add(MSG_ACK, match.match_id, seq, cell)
+            self.dirty.add(player)
+        # spectators before the opponent: a bot answers inside send_move,
+        # and its move must reach them after this one
+        if match.spectators:
+            self.fan_out(match, encode(MSG_MOVE, match.match_id, match.moves, cell))
+        opponent = match.opponent(player)
+        opponent.send_move(match.match_id, seq, cell)
+        self.dirty.add(opponent)
+        if result != ONGOING:
+            self.finish(match, result)
+
+    def finish(self, match, result):
+        "Tell both players the result once, then close the match"
+        del self.matches[match.match_id]
+        if self.journal is not None:
+            self.journal.result(match.match_id, result)
+        if self.results is not None:
+            x, o = match.players
+            self.results.record(x.name, o.name, result, match.moves, self.size, self.length, match.match_id)
+        for each in match.players:
+            if each.binary:
+                each.out.add(MSG_RESULT, match.match_id, 0, result)
+                if not each.closed:
+                    # one that is away keeps its token to learn the result
+                    del self.sessions[match.tokens[each.side]]
+            self.dirty.add(each)
+            self.closing.append(each)
+        frame = encode(MSG_RESULT, match.match_id, match.moves, result)
+        for spectator in match.spectators:
+            if spectator.lagging_since is not None:
+                self.snapshot(spectator, match)
+            spectator.out.data += frame
+            self.dirty_spectators.add(spectator)
+            self.closing.append(spectator)
+
+    def resume(self, player, game, token):
+        "A player back after losing its connection takes its seat again"
+        if player.joined or player.watching is not None:
+            return
+        owner = (game - self.first_match_id + self.shard) % self.shards
+        if owner != self.shard and isinstance(player, Channel):
+            # the other channels hold on to the socket, it cannot be passed on
+            self.no_match(player, game)
+            return
+        if owner != self.shard:
+            try:
+                self.pass_on(player, owner, game, token)
+            except OSError:
+                pass  # the client tries again
+            player.close()
+            return
+        match = self.sessions.get(token)
+        if match is None or match.match_id != game:
+            self.no_match(player, game)
+            return
+        side = match.tokens.index(token)
+        old = match.players[side]
+        old.close()  # a half open connection we have not noticed yet
+        if match.timers[side] is not None:
+            match.timers[side].cancel()
+            match.timers[side] = None
+        player.joined = True
+        player.match = match
+        player.side = side
+        player.name = old.name
+        match.players[side] = player
+        board = match.board
+        player.out.add(MSG_SNAPSHOT, match.match_id, match.moves, board.result, board.to_bytes())
+        self.dirty.add(player)
+        if board.result != ONGOING:
+            del self.sessions[token]
+            player.out.add(MSG_RESULT, match.match_id, 0, board.result)
+            self.closing.append(player)
+
+    def no_match(self, player, game):
+        "MSG_WATCH or MSG_RESUME for a match that is not here"
+        player.out.add(MSG_ERROR, game, 0, NO_MATCH)
+        self.dirty.add(player)
+        if isinstance(player, Channel):
+            self.closing.append(player)  # a channel serves one match, without one it is done
+
+    def abandon(self, match, player):
+        "The player did not come back in time, the match is given up"
+        if match.players[player.side] is not player:
+            return  # it did
+        match.timers[player.side] = None
+        self.sessions.pop(match.tokens[player.side], None)
+        if match.match_id in self.matches:
+            self.end(match)
+
+    def end(self, match):
+        "Close a match that cannot be finished"
+        del self.matches[match.match_id]
+        for token in match.tokens:
+            self.sessions.pop(token, None)
+        for each in match.players:
+            each.close()
+        for spectator in match.spectators:
+            spectator.close()
+
+    def address(self, shard):
+        return '%s-%d' % (self.handoff, shard)
+
+    def pass_on(self, player, shard, game=0, token=b''):
+        "Send the socket of player to another worker, which serves it from then on"
+        sock = player.writer.get_extra_info('socket')
+        # socket.send_fds() has no working address argument before 3.12
+        name = player.name.encode('utf-8')[:NAME_SIZE]
+        self.handoff_socket.sendmsg([HANDOFF.pack(player.rating, game, len(name)) + name + token],
+                                   [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [sock.fileno()]))],
+                                   0, self.address(shard))
+
+    def hand_off(self, player):
+        "Nobody came for player on this worker, worker 0 takes over its socket"
+        player.idle = None
+        if player.queued is None or player.closed:
+            return
+        try:
+            self.pass_on(player, 0)
+        except OSError:
+            # worker 0 is busy or restarting, try again later
+            player.idle = asyncio.get_running_loop().call_later(HANDOFF_AFTER, self.hand_off, player)
+            return
+        self.lobby.remove(player)
+        player.close()  # our copy of the socket, worker 0 holds the connection now
+
+    def adopt(self):
+        "Sockets handed over by the other workers"
+        while True:
+            try:
+                data, fds, flags, address = socket.recv_fds(self.handoff_socket,
+                                                             HANDOFF.size + NAME_SIZE + TOKEN_SIZE, 16)
+            except BlockingIOError:
+                return
+            rating, game, length = HANDOFF.unpack_from(data)
+            name = data[HANDOFF.size:HANDOFF.size + length].decode('utf-8', 'replace')
+            for fd in fds:
+                task = asyncio.create_task(self.adopted(socket.socket(fileno=fd), rating, game, name,
+                                                        data[HANDOFF.size + length:]))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def adopted(self, sock, rating, game, name, token):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        player = self.connect(reader, writer)
+        player.name = name
+        player.binary = True
+        player.decoder = FrameDecoder()
+        if token:
+            self.resume(player, game, token)
+        else:
+            player.joined = True
+            self.pair(player, rating)
+        self.flush_dirty()
+        await self.run_player(player)
+
+    def join(self, player, rating, name):
+        if not player.joined and player.watching is None:
+            player.joined = True
+            if name:
+                player.name = name[:NAME_SIZE].decode('utf-8', 'replace')
+            self.pair(player, rating or DEFAULT_RATING)
+
+    def watch(self, player, match_id):
+        match = self.matches.get(match_id)
+        if player.joined or player.watching is not None:
+            return
+        if match is None:
+            self.no_match(player, match_id)
+            return
+        player.watching = match
+        match.spectators.add(player)
+        self.snapshot(player, match)
+
+    def snapshot(self, spectator, match):
+        board = match.board
+        spectator.out.add(MSG_SNAPSHOT, match.match_id, match.moves, board.result, board.to_bytes())
+        self.dirty_spectators.add(spectator)
+
+    def fan_out(self, match, frame):
+        "Queue one encoded frame for every spectator that keeps up"
+        shed = []
+        for spectator in match.spectators:
+            backlog = spectator.backlog()
+            if spectator.lagging_since is not None:
+                if backlog > SPECTATOR_LOW:
+                    if time.monotonic() - spectator.lagging_since > SPECTATOR_MAX_LAG:
+                        shed.append(spectator)
+                    continue
+                # it caught up: one snapshot instead of every move it missed
+                spectator.lagging_since = None
+                self.snapshot(spectator, match)
+            elif backlog + len(frame) > SPECTATOR_BUFFER:
+                spectator.lagging_since = time.monotonic()
+            else:
+                spectator.out.data += frame
+                self.dirty_spectators.add(spectator)
+        for spectator in shed:
+            match.spectators.discard(spectator)
+            self.dirty_spectators.discard(spectator)
+            spectator.close()
+
+    def legacy(self, player):
+        "Nothing arrived in LEGACY_WAIT: a letter client waiting for its opponent, on 3x3"
+        if player.binary is None and not player.closed and self.size == 3:
+            player.binary = False
+            player.silent = True
+            self.pair(player)
+            self.flush_dirty()
+
+    def late_binary(self, player):
+        """A frame came from a player paired as a silent letter client, its
+        first frame was only late. Returns whether it can go on as binary"""
+        match = player.match
+        if match is not None and match.moves:
+            return False  # the moves went out as letters, they cannot be taken back
+        player.binary = True
+        player.decoder = FrameDecoder()
+        if match is None:
+            self.lobby.remove(player)  # its MSG_JOIN pairs it again
+            if player.idle is not None:
+                player.idle.cancel()
+                player.idle = None
+        else:
+            player.joined = True  # nothing was sent yet, it keeps its seat as a binary player
+            self.sessions[match.tokens[player.side]] = match
+            self.start(player)
+        return True
+
+    def connect(self, reader, writer):
+        player = Player(reader, writer)
+        peer = writer.get_extra_info('peername')
+        player.name = peer[0] if isinstance(peer, tuple) else 'anonymous'
+        if self.limits is not None:
+            player.limiter = Limiter(*self.limits)
+        return player
+
+    def on_data(self, player, data):
+        limiter = player.limiter
+        if limiter is not None:
+            limiter.read(data)
+        if player.binary is None:
+            player.binary = data[0] not in LETTERS
+            if player.binary:
+                player.decoder = FrameDecoder()
+            elif self.size != 3:
+                print("refused letter client %s, letters only cover a 3x3 board" % player.name)
+                raise ProtocolError("letters on a %dx%d board" % (self.size, self.size))
+            else:
+                self.pair(player)
+        elif player.silent:
+            player.silent = False
+            # a frame never starts with a letter, see tictactoe_protocol.py
+            if data[0] not in LETTERS and not self.late_binary(player):
+                raise ProtocolError("frames from a player already sent letters")
+        if player.binary:
+            frames = player.decoder.feed(data)
+            if limiter is not None:
+                limiter.frames(len(frames))
+            self.dispatch(player, frames)
+        else:
+            if limiter is not None:
+                limiter.frames(len(data))
+            # a single read may carry several letters, play every one of them
+            for letter in data:
+                if letter in CELL_OF_LETTER:
+                    self.move(player, 0, CELL_OF_LETTER[letter])
+        self.flush_dirty()
+
+    def dispatch(self, player, frames):
+        for msg_type, game, seq, cell, payload in frames:
+            if msg_type == MSG_MOVE:
+                self.move(player, seq, cell)
+            elif msg_type == MSG_JOIN:
+                self.join(player, cell, payload)
+            elif msg_type == MSG_WATCH:
+                self.watch(player, game)
+            elif msg_type == MSG_RESUME:
+                self.resume(player, game, payload)
+            elif msg_type == MSG_CHANNEL and not isinstance(player, Channel):
+                self.on_channel(player, cell, payload)
+
+    def on_channel(self, conn, number, payload):
+        "The frames of one envelope, handled by the channel they are for"
+        if conn.channels is None:
+            conn.channels = {}
+            conn.scheduler = Scheduler(conn)
+        channel = conn.channels.get(number)
+        if not payload:
+            if channel is not None:
+                self.drop(channel)  # the client closed it
+            return
+        frames = unpack_envelope(payload)
+        if conn.limiter is not None:
+            conn.limiter.frames(len(frames) - 1)  # the envelope itself is paid for
+        if channel is None:
+            if not any(frame[0] in CHANNEL_OPENERS for frame in frames):
+                return  # still in flight for a channel the server closed, or no channel at all
+            if len(conn.channels) >= MAX_CHANNELS:
+                raise ProtocolError("more than %d channels" % MAX_CHANNELS)
+            channel = conn.channels[number] = Channel(conn, number)
+            if conn.limiter is not None:
+                conn.limiter.share(min(len(conn.channels), CHANNEL_SHARE))
+        self.dispatch(channel, frames)
+
+    def flush_dirty(self):
+        "Everything produced since the last flush leaves in one write per socket"
+        for each in self.dirty:
+            each.flush()
+        self.dirty.clear()
+        # spectators only after the players
+        for each in self.dirty_spectators:
+            each.flush()
+        self.dirty_spectators.clear()
+        # finished matches close only after their last frames are written
+        for each in self.closing:
+            each.close()
+        self.closing.clear()
+
+    def drop(self, player):
+        player.close()
+        self.lobby.remove(player)
+        if player.idle is not None:
+            player.idle.cancel()
+        if player.watching is not None:
+            player.watching.spectators.discard(player)
+        if player.channels:
+            for channel in list(player.channels.values()):
+                self.drop(channel)
+        match = player.match
+        if match is None or match.match_id not in self.matches or match.players[player.side] is not player:
+            return
+        if player.binary:
+            # the seat is kept for a while, the player may come back with its token
+            match.timers[player.side] = asyncio.get_running_loop().call_later(
+                RESUME_WINDOW, self.abandon, match, player)
+        else:
+            # a letter client cannot come back, the game is over for both sides
+            self.end(match)
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.handlers.add(task)
+        player = self.connect(reader, writer)
+        waiting = asyncio.get_running_loop().call_later(LEGACY_WAIT, self.legacy, player)
+        try:
+            await self.run_player(player)
+        except asyncio.CancelledError:
+            pass  # the server is stopping, the connection was dropped on the way out
+        finally:
+            waiting.cancel()
+            self.handlers.discard(task)
+
+    async def run_player(self, player):
+        reader = player.reader
+        try:
+            while True:
+                data = await reader.read(2048)
+                if not data:
+                    break
+                self.on_data(player, data)
+        except (ConnectionError, ProtocolError):
+            pass
+        finally:
+            self.drop(player)
+
+    async def sync_journal(self, interval):
+        "Write the journal buffer every interval and fsync it off the loop"
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            self.journal.write()
+            await loop.run_in_executor(None, self.journal.sync)
+
+    async def heartbeat(self, fd):
+        "Tell the supervisor that this event loop still comes round"
+        while True:
+            beat(fd)
+            await asyncio.sleep(HEARTBEAT / 2)
+
+    async def serve(self, host=HOST, port=PORT, backlog=4096, journal_sync=0.1,
+                    reuse_port=False, heartbeat=None):
+        loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle, host, port, reuse_address=True,
+                                            reuse_port=reuse_port or None, backlog=backlog)
+        print("listening on %s:%d" % (host, port))
+        background = []
+        if self.journal is not None:
+            background.append(asyncio.create_task(self.sync_journal(journal_sync)))
+        if heartbeat is not None:
+            background.append(asyncio.create_task(self.heartbeat(heartbeat)))
+        if self.handoff is not None:
+            self.handoff_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.handoff_socket.setblocking(False)
+            self.handoff_socket.bind(self.address(self.shard))
+            loop.add_reader(self.handoff_socket, self.adopt)
+        # ctrl-c and kill stop the loop from inside, the files are closed below
+        stop = asyncio.Event()
+        signals = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except NotImplementedError:  # windows, ctrl-c raises KeyboardInterrupt instead
+                break
+            signals.append(signum)
+        try:
+            async with server:
+                await stop.wait()
+                server.close()
+                connections = self.handlers | self.tasks
+                for task in connections:
+                    task.cancel()
+                await asyncio.gather(*connections, return_exceptions=True)
+        finally:
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+            for task in background:
+                task.cancel()
+            if self.handoff_socket is not None:
+                loop.remove_reader(self.handoff_socket)
+                self.handoff_socket.close()
+            if self.journal is not None:
+                self.journal.close()
+            if self.results is not None:
+                self.results.close()
+            if isinstance(self.bot, BotPool):
+                self.bot.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="headless Tic Tac Toe server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--size', type=int, default=3, help="board size, the board is size x size")
+    parser.add_argument('--length', type=int, default=None, help="stones in a row that win, default size")
+    parser.add_argument('--bot', action='store_true', help="every client plays the computer")
+    parser.add_argument('--bot-time', type=float, default=None, help="seconds the bot may think per move")
+    parser.add_argument('--bot-after', type=float, default=None,
+                        help="seconds a player waits for an opponent before playing the bot")
+    parser.add_argument('--buckets', type=int, default=None,
+                        help="pair players by rating // BUCKETS instead of first come first served")
+    parser.add_argument('--reach', type=int, default=1, help="buckets an opponent may be away")
+    parser.add_argument('--table', default=None, help="perfect play table for the bot, see tictactoe_table.py")
+    parser.add_argument('--journal', default=None, help="append every match to this journal file")
+    parser.add_argument('--results', default=None, help="keep finished matches in this SQLite file")
+    parser.add_argument('--journal-sync', type=float, default=0.1, help="seconds between journal fsyncs")
+    parser.add_argument('--max-messages', type=int, default=100,
+                        help="messages a second per connection before it is closed, 0 for no limit")
+    parser.add_argument('--max-bytes', type=int, default=64 * 1024,
+                        help="bytes a second per connection before it is closed, 0 for no limit")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="server processes sharing the port with SO_REUSEPORT, 0 for one per CPU")
+    args = parser.parse_args(argv)
+    if not 3 <= args.size <= 255:
+        parser.error("--size must be between 3 and 255")
+    if args.length is not None and not 2 <= args.length <= args.size:
+        parser.error("--length must be between 2 and --size")
+    if args.table and (args.size, args.length) not in ((3, None), (3, 3)):
+        parser.error("the perfect play table only covers 3x3")
+    if args.workers < 0:
+        parser.error("--workers must not be negative")
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        parser.error("--workers needs fork() and SO_REUSEPORT")
+    raise_fd_limit()
+    bot = None
+    wants_bot = args.bot or args.bot_after is not None
+    if wants_bot and args.table:
+        bot = PerfectPlayTable(args.table)
+    elif wants_bot:
+        bot_time = args.bot_time
+        if bot_time is None and args.size > 3:
+            bot_time = 0.5  # larger boards cannot be searched to the end
+        # the workers of all server processes share the cores
+        bot = BotPool(args.size, args.length, bot_time, max(1, (os.cpu_count() or 1) // workers))
+    first_match_id = 1
+    if args.journal:
+        # match ids go on from the last run so they stay unique in the file
+        first_match_id = next_match_id(args.journal)
+        Journal(args.journal).close()  # writes the file header once, before any fork
+    bot_after = None if args.bot else args.bot_after
+    sharded = workers > 1
+    limits = None
+    if args.max_messages or args.max_bytes:
+        limits = (args.max_messages, args.max_bytes)
+
+    def start(shard=0, heartbeat=None):
+        # runs in every worker, each opens the journal after the fork
+        journal = Journal(args.journal) if args.journal else None
+        results = ResultStore(args.results) if args.results else None
+        handoff = '\0tictactoe-%d' % args.port if sharded else None  # abstract unix sockets
+        server = GameServer(bot, args.size, args.length, journal, first_match_id + shard,
+                            Lobby(args.buckets, args.reach), bot_after, shard, workers, handoff,
+                            limits, results)
+        asyncio.run(server.serve(args.host, args.port, journal_sync=args.journal_sync,
+                                 reuse_port=sharded, heartbeat=heartbeat))
+
+    if sharded:
+        Supervisor(workers, start).run()
+        return
+    try:
+        start()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Precomputed perfect play for 3x3 Tic Tac Toe.
+
+Only 5478 positions can be reached from the empty board, 4520 of them with
+a move still to make, so instead of searching at all the whole game is
+solved once, offline, and written to a small binary file:
+
+    python tictactoe_table.py tictactoe_table.bin
+
+The file is a 4 byte magic followed by one little endian uint16 for every
+base-3 board index (x = 1, o = 2 per cell, cell 0 lowest), 19683 entries,
+39 KB. Each entry holds
+
+    bits 0-8   every best move for the side to move
+    bits 9-10  the value for the side to move: LOSS, DRAW or WIN
+    bit 15     set when the position is reachable and not finished
+
+PerfectPlayTable memory-maps the file read only. A lookup is two table
+reads to build the index and one read of the map; worker processes that
+open or inherit the same file share its pages through the page cache
+instead of each holding a copy. It has the same choose() as AlphaBetaBot,
+so the server can use either one.
+"""
+
+import mmap
+import struct
+import sys
+
+from tictactoe_board import FULL, WINNING, X
+
+MAGIC = b'TTT1'
+ENTRIES = 3 ** 9
+LOSS, DRAW, WIN = 0, 1, 2
+VALUE_SHIFT = 9
+LIVE = 1 << 15
+
+# TERNARY[mask] is the base-3 number with a 1 digit for every bit of mask
+TERNARY = [sum(3 ** cell for cell in range(9) if mask >> cell & 1) for mask in range(FULL + 1)]
+
+
+def index_of(x, o):
+    return TERNARY[x] + 2 * TERNARY[o]
+
+
+def solve():
+    "Return the table entries of every reachable position"
+    entries = [0] * ENTRIES
+    scores = {}
+
+    def score(me, opp):
+        # the side to move owns me; a win scores more the earlier it comes
+        key = (me, opp)
+        if key in scores:
+            return scores[key]
+        empty = FULL & ~(me | opp)
+        remaining = bin(empty).count('1')
+        if not empty:
+            scores[key] = 0
+            return 0
+        results = {}
+        for cell in range(9):
+            bit = 1 << cell
+            if empty & bit:
+                if WINNING[me | bit]:
+                    results[cell] = remaining
+                else:
+                    results[cell] = -score(opp, me | bit)
+        best = max(results.values())
+        moves = 0
+        for cell, value in results.items():
+            if value == best:
+                moves |= 1 << cell
+        value = WIN if best > 0 else LOSS if best < 0 else DRAW
+        # x moves when an odd number of cells is still free
+        x, o = (me, opp) if remaining % 2 else (opp, me)
+        entries[index_of(x, o)] = LIVE | value << VALUE_SHIFT | moves
+        scores[key] = best
+        return best
+
+    score(0, 0)
+    return entries
+
+
+def generate(path):
+    entries = solve()
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<%dH' % ENTRIES, *entries))
+    return sum(1 for entry in entries if entry)
+
+
+class PerfectPlayTable:
+    "Read only view of a generated table file"
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC or len(self.map) != len(MAGIC) + 2 * ENTRIES:
+            self.map.close()
+            raise ValueError("%s is not a tic tac toe table" % path)
+        if sys.byteorder == 'little':
+            # entries are read straight out of the mapped pages, no copy
+            self.entries = memoryview(self.map)[len(MAGIC):].cast('H')
+        else:
+            self.entries = struct.unpack('<%dH' % ENTRIES, self.map[len(MAGIC):])
+
+    def entry(self, x, o):
+        entry = self.entries[index_of(x, o)]
+        if not entry & LIVE:
+            raise ValueError("the position is finished or cannot be reached")
+        return entry
+
+    def value(self, x, o):
+        "LOSS, DRAW or WIN for the side to move"
+        return self.entry(x, o) >> VALUE_SHIFT & 3
+
+    def best_moves(self, x, o):
+        "Every move that keeps the best result, for hints"
+        moves = self.entry(x, o) & FULL
+        return [cell for cell in range(9) if moves >> cell & 1]
+
+    def choose(self, x, o, side=X):
+        "The lowest best move; side is implied by the position"
+        moves = self.entry(x, o) & FULL
+        return (moves & -moves).bit_length() - 1
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'tictactoe_table.bin'
+    print("%d live positions written to %s" % (generate(path), path))
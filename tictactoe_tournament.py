@@ -0,0 +1,246 @@
+"""
+Bot against bot tournament, the throughput benchmark of the engine and bots.
+
+Every ordered pair of the given strategies plays --games games, the first
+of the pair as x (a single strategy plays itself). The games are cut into
+chunks of --chunk and the chunks run on a ProcessPoolExecutor, one process
+per core. A worker keeps its bots between chunks, so the alpha-beta
+transposition table stays warm and the perfect play table is mapped once
+per process, not once per game.
+
+Results are streamed to --out while the chunks come back, a chunk is
+written with one write call and never kept in memory. The file is
+    magic     4s  b'TTR1'
+    size      B   board size
+    length    B   stones in a row that win
+    count     B   number of strategy names, then each name as
+                  one length byte and the ascii name
+followed by one record of 9 bytes per game, little endian:
+    game      I   game number
+    x         B   index of x's strategy in the names
+    o         B   index of o's strategy
+    result    B   X_WINS, O_WINS or DRAW
+    moves     H   stones on the board at the end
+read_results() gives the names, the board setting and the records.
+
+The report on stdout is JSON: win and draw rates of every pairing, games
+and moves per second over the whole run.
+
+    python tictactoe_tournament.py --strategies random greedy minimax --games 100000
+    python tictactoe_tournament.py --strategies table random --workers 1 2 4
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import struct
+import time
+
+from tictactoe_bench import STRATEGIES as BENCH_STRATEGIES
+from tictactoe_board import Board, DRAW, O_WINS, ONGOING, X, X_WINS
+from tictactoe_mcts import MCTSBot
+from tictactoe_table import PerfectPlayTable
+
+MAGIC = b'TTR1'
+RECORD = struct.Struct('<IBBBH')
+
+# set in every worker by configure()
+TABLE = 'tictactoe_table.bin'
+MCTS_TIME = 0.05
+
+
+def greedy_move(board, rng):
+    "Win at once if possible, else block the opponent's win, else random"
+    side = board.to_move()
+    free = board.free_cells()
+    for mask in ((board.x, board.o) if side == X else (board.o, board.x)):
+        for cell in free:
+            if board.wins_through(mask | 1 << cell, cell):
+                return cell
+    return rng.choice(free)
+
+
+tables = {}
+
+
+def table_move(board, rng):
+    # one mapping of the file per process, the pages are shared between them
+    if TABLE not in tables:
+        tables[TABLE] = PerfectPlayTable(TABLE)
+    return tables[TABLE].choose(board.x, board.o)
+
+
+mcts_bots = {}
+
+
+def mcts_move(board, rng):
+    key = (board.size, board.length)
+    if key not in mcts_bots:
+        mcts_bots[key] = MCTSBot(board.size, board.length, MCTS_TIME, workers=1)
+    return mcts_bots[key].choose(board.x, board.o, board.to_move())
+
+
+STRATEGIES = dict(BENCH_STRATEGIES, greedy=greedy_move, table=table_move, mcts=mcts_move)
+
+
+def configure(table, mcts_time):
+    "Pool initializer, the options every worker needs"
+    global TABLE, MCTS_TIME
+    TABLE = table
+    MCTS_TIME = mcts_time
+
+
+def play_chunk(x_name, o_name, x_index, o_index, size, length, first_game, games, seed):
+    """Play games games between two strategies, this is what runs in the
+    workers. Returns the packed records, the count of every result and the
+    number of moves"""
+    rng = random.Random(seed)
+    strategies = (STRATEGIES[x_name], STRATEGIES[o_name])
+    start = Board(size=size, length=length)
+    records = bytearray()
+    results = [0, 0, 0, 0]
+    moves = 0
+    for game in range(first_game, first_game + games):
+        board = start.copy()
+        side = X
+        played = 0
+        while board.result == ONGOING:
+            board.play(strategies[side](board, rng), side)
+            side = 1 - side
+            played += 1
+        records += RECORD.pack(game, x_index, o_index, board.result, played)
+        results[board.result] += 1
+        moves += played
+    return bytes(records), results, moves
+
+
+def write_header(f, names, size, length):
+    f.write(MAGIC + bytes((size, length, len(names))))
+    for name in names:
+        encoded = name.encode('ascii')
+        f.write(bytes((len(encoded),)) + encoded)
+
+
+def read_header(data, path):
+    "The strategy names, size, length and where the records start"
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a tournament result file" % path)
+    size, length, count = data[4:7]
+    pos = 7
+    names = []
+    for _ in range(count):
+        names.append(data[pos + 1:pos + 1 + data[pos]].decode('ascii'))
+        pos += 1 + data[pos]
+    return names, size, length, pos
+
+
+def read_results(path):
+    "The strategy names, size, length and a list of (game, x, o, result, moves)"
+    with open(path, 'rb') as f:
+        data = f.read()
+    names, size, length, pos = read_header(data, path)
+    end = pos + (len(data) - pos) // RECORD.size * RECORD.size  # a record still being written
+    return names, size, length, list(RECORD.iter_unpack(memoryview(data)[pos:end]))
+
+
+def schedule(pairings, games, chunk, seed):
+    "Every chunk of every pairing as the arguments of play_chunk"
+    rng = random.Random(seed)
+    game = 0
+    for x_index, o_index in pairings:
+        left = games
+        while left:
+            count = min(chunk, left)
+            yield x_index, o_index, game, count, rng.getrandbits(64)
+            game += count
+            left -= count
+
+
+def run(names, size, length, games, workers, chunk, out, seed=None, table=TABLE, mcts_time=MCTS_TIME):
+    if len(names) == 1:
+        pairings = [(0, 0)]
+    else:
+        pairings = [(a, b) for a in range(len(names)) for b in range(len(names)) if a != b]
+    totals = collections.defaultdict(lambda: [0, 0, 0, 0])
+    moves = 0
+    with open(out, 'wb') as f:
+        write_header(f, names, size, length)
+
+        def collect(x_index, o_index, done):
+            nonlocal moves
+            records, results, played = done
+            f.write(records)
+            counts = totals[x_index, o_index]
+            for result in (X_WINS, O_WINS, DRAW):
+                counts[result] += results[result]
+            moves += played
+
+        chunks = schedule(pairings, games, chunk, seed)
+        started = time.perf_counter()
+        if workers == 1:
+            configure(table, mcts_time)
+            for x_index, o_index, first, count, chunk_seed in chunks:
+                collect(x_index, o_index, play_chunk(names[x_index], names[o_index], x_index, o_index,
+                                                     size, length, first, count, chunk_seed))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(workers, initializer=configure,
+                                                        initargs=(table, mcts_time)) as pool:
+                # a few chunks per worker in flight, millions of games are never all queued
+                pending = {}
+                for x_index, o_index, first, count, chunk_seed in chunks:
+                    if len(pending) >= 4 * workers:
+                        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            collect(*pending.pop(future), future.result())
+                    future = pool.submit(play_chunk, names[x_index], names[o_index], x_index, o_index,
+                                         size, length, first, count, chunk_seed)
+                    pending[future] = (x_index, o_index)
+                for future in concurrent.futures.as_completed(pending):
+                    collect(*pending[future], future.result())
+        elapsed = time.perf_counter() - started
+    report = []
+    for (x_index, o_index), counts in totals.items():
+        played = counts[X_WINS] + counts[O_WINS] + counts[DRAW]
+        report.append({'x': names[x_index], 'o': names[o_index], 'games': played,
+                       'x_win_rate': round(counts[X_WINS] / played, 4),
+                       'o_win_rate': round(counts[O_WINS] / played, 4),
+                       'draw_rate': round(counts[DRAW] / played, 4)})
+    report.sort(key=lambda row: (row['x'], row['o']))
+    total = games * len(pairings)
+    return {'size': size, 'length': length, 'workers': workers, 'games': total,
+            'elapsed_sec': round(elapsed, 4),
+            'games_per_sec': round(total / elapsed, 1),
+            'moves_per_sec': round(moves / elapsed, 1),
+            'pairings': report}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="bot against bot tournament and engine benchmark")
+    parser.add_argument('--strategies', nargs='+', choices=sorted(STRATEGIES), default=['random', 'greedy'])
+    parser.add_argument('--games', type=int, default=10000, help="games of every ordered pairing")
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--length', type=int, default=None)
+    parser.add_argument('--workers', type=int, nargs='+', default=[os.cpu_count() or 1],
+                        help="process counts to run the tournament with, one run each")
+    parser.add_argument('--chunk', type=int, default=1000, help="games per task sent to a worker")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--table', default=TABLE, help="perfect play table for the table strategy")
+    parser.add_argument('--mcts-time', type=float, default=MCTS_TIME, help="seconds per mcts move")
+    parser.add_argument('--out', default='tournament.ttr')
+    args = parser.parse_args(argv)
+    length = args.size if args.length is None else args.length
+    if 'table' in args.strategies and (args.size, length) != (3, 3):
+        parser.error("the perfect play table only covers 3x3")
+    if len(args.strategies) > 255:
+        parser.error("at most 255 strategies")
+    runs = [run(args.strategies, args.size, length, args.games, workers, args.chunk, args.out,
+                args.seed, args.table, args.mcts_time)
+            for workers in args.workers]
+    print(json.dumps(runs[0] if len(runs) == 1 else runs, indent=2))
+
+
+if __name__ == '__main__':
+    main()